@@ -0,0 +1,157 @@
+"""
+Asyncio runtime for I/O-bound command groups.
+
+Messages are consumed with `aio_pika` and many commands run at once in one process.
+Commands are still the existing click groups, they run in a thread pool while
+their Slack posts go out through one shared `aiohttp` session on the event loop.
+"""
+import asyncio
+from json import loads
+from typing import Any
+from typing import Dict
+from typing import Tuple
+from concurrent.futures import Executor
+
+from . import config
+from .types import Worker
+from .slack import _limits
+from .slack import _TIMEOUT
+from .slack import Response as SlackResponse
+
+
+def _log_post_error(future) -> None:
+    """Posts are not awaited by the command, their errors would be lost."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"slack post failed: {repr(future.exception())}")
+
+
+class AsyncResponse(SlackResponse):
+    """
+    Slack response for commands running under `AsyncWorker`.
+    Posts are scheduled on the event loop and do not block the command,
+    they are sent in the order they were made.
+    """
+
+    def __init__(self, event: Dict[str, Any], loop: asyncio.AbstractEventLoop, session):
+        super().__init__(event)
+        self._loop = loop
+        self._session = session
+        self._lock = asyncio.Lock()
+
+    def _post(self, data: Dict[str, Any]):
+        future = asyncio.run_coroutine_threadsafe(self._apost(data), self._loop)
+        future.add_done_callback(_log_post_error)
+        return future
+
+    async def _apost(self, data: Dict[str, Any]) -> dict:
+        import aiohttp
+
+        # aiohttp only encodes strings, requests drops `None` and stringifies the rest
+        data = {k: str(v) for k, v in data.items() if v is not None}
+        async with self._lock:
+            while True:
+                wait = _limits.wait_time(self, data)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                async with self._session.post(
+                    config.SLACK_API_MESSAGE_POST,
+                    headers=self.auth_headers,
+                    data=data,
+                    timeout=aiohttp.ClientTimeout(total=_TIMEOUT),
+                ) as response:
+                    if response.status != 429:
+                        return await response.json()
+                    _limits.pause(data, float(response.headers.get("Retry-After", 1)))
+
+    def _check_post_to_thread(self):
+        return asyncio.run_coroutine_threadsafe(
+            self._acheck_post_to_thread(), self._loop
+        ).result()
+
+    async def _acheck_post_to_thread(self) -> bool:
+        import aiohttp
+
+        async with self._session.get(
+            config.SLACK_API_CONVERSATION_HISTORY,
+            headers=self.auth_headers,
+            params={"channel": self.event["channel"], "limit": 1},
+            timeout=aiohttp.ClientTimeout(total=_TIMEOUT),
+        ) as response:
+            response = await response.json()
+        return not response["messages"][0]["ts"] == self.event["ts"]
+
+
+class AsyncWorker(Worker):
+    """
+    Alternative to `Worker` for command groups that mostly wait on HTTP.
+    Up to `WORKER_CONCURRENCY` (default 100) commands run at once,
+    each message is acked once its command returns.
+    With `WORKER_LONG_CONCURRENCY` > 0 long jobs run in their own pool.
+    """
+
+    async def _handle(self, message, executors: Tuple[Executor, ...], session) -> None:
+        async with message.process(requeue=False):
+            event = loads(message.body)["event"]
+            path = self._table.resolve(event["user_cmd"].split())
+            executor = executors[-1] if self._table.is_long_job(path) else executors[0]
+            response = AsyncResponse(event, asyncio.get_running_loop(), session)
+            await asyncio.get_running_loop().run_in_executor(
+                executor, self._invoke_cmd, event["user_cmd"], response
+            )
+
+    async def _aconsume(self, routing_key: str) -> None:
+        import aiohttp
+        import aio_pika
+        from concurrent.futures import ThreadPoolExecutor
+
+        concurrency = config.WORKER_CONCURRENCY or 100
+        executors = (ThreadPoolExecutor(concurrency, thread_name_prefix="worker"),)
+        if config.WORKER_LONG_CONCURRENCY > 0:
+            executors += (
+                ThreadPoolExecutor(
+                    config.WORKER_LONG_CONCURRENCY, thread_name_prefix="worker-long"
+                ),
+            )
+        connection = await aio_pika.connect_robust(
+            host=config.AMQP_SERVICE_HOST,
+            login=config.AMQP_USERNAME,
+            password=config.AMQP_PASSWORD,
+        )
+        async with connection, aiohttp.ClientSession() as session:
+            channel = await connection.channel()
+            await channel.set_qos(
+                prefetch_count=config.WORKER_PREFETCH_COUNT or concurrency
+            )
+            exchange = await channel.declare_exchange(
+                config.EXCHANGE_NAME, aio_pika.ExchangeType.TOPIC
+            )
+            if config.WORKER_SHARED_QUEUES:
+                queue = await channel.declare_queue(
+                    self._shared_queue_name(routing_key), durable=True
+                )
+            else:
+                queue = await channel.declare_queue(exclusive=True)
+            await queue.bind(exchange, routing_key)
+
+            print(" [*] Waiting for work. To exit press CTRL+C")
+            tasks = set()
+            async with queue.iterator() as messages:
+                async for message in messages:
+                    task = asyncio.ensure_future(
+                        self._handle(message, executors, session)
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        for executor in executors:
+            executor.shutdown(wait=False)
+
+    def start(self, routing_key: str, callback: callable = None):
+        """
+        Consume messages for `routing_key` until interrupted.
+        `callback` is accepted for compatibility with `Worker.start`,
+        messages are always dispatched to `_invoke_cmd`.
+        """
+        print(f"initializing async worker for {routing_key}")
+        self._serve_metrics()
+        asyncio.run(self._aconsume(routing_key))
@@ -1,13 +1,15 @@
+"""
+Config and AMQP connection are created on first use and reused after that,
+importing this package does not read the environment or connect to anything.
+"""
 from os import environ
+from functools import lru_cache
 from collections import namedtuple
 
-from pika import BlockingConnection
-from pika import ConnectionParameters
-from pika.credentials import PlainCredentials
-
 
 _config_fields = (
     "SLACK_API_USER_INFO",
+    "SLACK_API_USERS_LIST",
     "SLACK_API_MESSAGE_POST",
     "SLACK_API_CONVERSATION_HISTORY",
     "SLACK_API_BOT_ACCESS_TOKEN",
@@ -15,26 +17,104 @@ _config_fields = (
     "AMQP_USERNAME",
     "AMQP_PASSWORD",
     "EXCHANGE_NAME",
+    "WORKER_CONCURRENCY",
+    "WORKER_POOL",
+    "WORKER_PREFETCH_COUNT",
+    "WORKER_SHARED_QUEUES",
+    "WORKER_RUNTIME",
+    "SLACK_ASYNC_SEND",
+    "SLACK_CHANNEL_RATE",
+    "SLACK_WORKSPACE_RATE",
+    "SLACK_THREAD_CHECK_INTERVAL",
+    "ADMIN_CACHE_TTL",
+    "LOCAL_ADMINS",
+    "SLACK_USER_CACHE_TTL",
+    "SLACK_USERS_WARMUP",
+    "METRICS_PORT",
+    "WORKER_PROFILE",
+    "WORKER_PROFILE_TOP",
+    "WORKER_LONG_CONCURRENCY",
 )
-_config_defaults = (
-    environ.get("SLACK_API_USER_INFO", "https://slack.com/api/users.info"),
-    environ.get("SLACK_API_MESSAGE_POST", "https://slack.com/api/chat.postMessage"),
-    environ.get(
-        "SLACK_API_CONVERSATION_HISTORY", "https://slack.com/api/conversations.history"
-    ),
-    environ["SLACK_API_BOT_ACCESS_TOKEN"],
-    environ.get("AMQP_SERVICE_HOST", "localhost"),
-    environ.get("AMQP_USERNAME", "guest"),
-    environ.get("AMQP_PASSWORD", "guest"),
-    environ.get("EXCHANGE_NAME", "cloud_bot"),
-)
-Config = namedtuple("Config", _config_fields, defaults=_config_defaults)
-config = Config()
-
-print(f"amqp host {config.AMQP_SERVICE_HOST}")
-amqp_connection = BlockingConnection(
-    ConnectionParameters(
-        host=config.AMQP_SERVICE_HOST,
-        credentials=PlainCredentials(config.AMQP_USERNAME, config.AMQP_PASSWORD),
+Config = namedtuple("Config", _config_fields)
+
+
+def _config_values() -> tuple:
+    return (
+        environ.get("SLACK_API_USER_INFO", "https://slack.com/api/users.info"),
+        environ.get("SLACK_API_USERS_LIST", "https://slack.com/api/users.list"),
+        environ.get("SLACK_API_MESSAGE_POST", "https://slack.com/api/chat.postMessage"),
+        environ.get(
+            "SLACK_API_CONVERSATION_HISTORY",
+            "https://slack.com/api/conversations.history",
+        ),
+        environ["SLACK_API_BOT_ACCESS_TOKEN"],
+        environ.get("AMQP_SERVICE_HOST", "localhost"),
+        environ.get("AMQP_USERNAME", "guest"),
+        environ.get("AMQP_PASSWORD", "guest"),
+        environ.get("EXCHANGE_NAME", "cloud_bot"),
+        int(environ.get("WORKER_CONCURRENCY", 0)),
+        environ.get("WORKER_POOL", "thread"),
+        int(environ.get("WORKER_PREFETCH_COUNT", 0)),
+        True if environ.get("WORKER_SHARED_QUEUES") else False,
+        environ.get("WORKER_RUNTIME", "blocking"),
+        True if environ.get("SLACK_ASYNC_SEND") else False,
+        float(environ.get("SLACK_CHANNEL_RATE", 1)),
+        float(environ.get("SLACK_WORKSPACE_RATE", 10)),
+        float(environ.get("SLACK_THREAD_CHECK_INTERVAL", 10)),
+        float(environ.get("ADMIN_CACHE_TTL", 300)),
+        frozenset(environ["LOCAL_ADMINS"].split(","))
+        if "LOCAL_ADMINS" in environ
+        else None,
+        float(environ.get("SLACK_USER_CACHE_TTL", 3600)),
+        True if environ.get("SLACK_USERS_WARMUP") else False,
+        int(environ.get("METRICS_PORT", 0))
+        + int(environ.get("METRICS_PORT_OFFSET", 0))
+        if environ.get("METRICS_PORT")
+        else 0,
+        True if environ.get("WORKER_PROFILE") else False,
+        int(environ.get("WORKER_PROFILE_TOP", 15)),
+        int(environ.get("WORKER_LONG_CONCURRENCY", 0)),
     )
-)
+
+
+class _Lazy:
+    """Stand-in that creates the object with `factory` on first attribute access."""
+
+    def __init__(self, factory: callable):
+        self._factory = factory
+
+    def __getattr__(self, name: str):
+        return getattr(self._factory(), name)
+
+
+@lru_cache(maxsize=None)
+def get_config() -> Config:
+    return Config(*_config_values())
+
+
+_amqp_connection = None
+
+
+def get_amqp_connection():
+    """Connection shared by the process, reopened if it was closed."""
+    global _amqp_connection
+    from pika import BlockingConnection
+    from pika import ConnectionParameters
+    from pika.credentials import PlainCredentials
+
+    if _amqp_connection is None or _amqp_connection.is_closed:
+        config = get_config()
+        print(f"amqp host {config.AMQP_SERVICE_HOST}")
+        _amqp_connection = BlockingConnection(
+            ConnectionParameters(
+                host=config.AMQP_SERVICE_HOST,
+                credentials=PlainCredentials(
+                    config.AMQP_USERNAME, config.AMQP_PASSWORD
+                ),
+            )
+        )
+    return _amqp_connection
+
+
+config = _Lazy(get_config)
+amqp_connection = _Lazy(get_amqp_connection)
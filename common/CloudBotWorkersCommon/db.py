@@ -1,10 +1,63 @@
-from google.cloud import firestore
+from time import monotonic
+from functools import lru_cache
+from threading import Lock
 
+from . import config
 
-db = firestore.Client()
 
+@lru_cache(maxsize=None)
+def get_db():
+    """Firestore client, created on first use."""
+    from google.cloud import firestore
 
-def is_admin(user_id: str) -> bool:
-    doc_ref = db.collection("admins").document(user_id)
-    return doc_ref.get().exists
+    return firestore.Client()
+
+
+class _AdminCache:
+    """
+    Ids in the `admins` collection, loaded once and kept current by a snapshot
+    listener. If the listener stops, ids older than `ADMIN_CACHE_TTL` seconds
+    are reloaded. `LOCAL_ADMINS` (comma separated ids) replaces firestore.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._load_lock = Lock()
+        self._admins = frozenset()
+        self._loaded_at = None
+        self._watch = None
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        with self._lock:
+            self._admins = frozenset(doc.id for doc in docs)
+            self._loaded_at = monotonic()
+
+    def _load(self) -> None:
+        collection = get_db().collection("admins")
+        if self._watch is not None and not self._watch.is_active:
+            self._watch.unsubscribe()
+            self._watch = None
+        if self._watch is None:
+            self._watch = collection.on_snapshot(self._on_snapshot)
+        self._on_snapshot(collection.select([]).stream(), None, None)
 
+    def _listening(self) -> bool:
+        return self._watch is not None and self._watch.is_active
+
+    def admins(self) -> frozenset:
+        if config.LOCAL_ADMINS is not None:
+            return config.LOCAL_ADMINS
+        with self._load_lock:
+            if self._loaded_at is None or (
+                not self._listening()
+                and monotonic() - self._loaded_at > config.ADMIN_CACHE_TTL
+            ):
+                self._load()
+        return self._admins
+
+
+_admin_cache = _AdminCache()
+
+
+def is_admin(user_id: str) -> bool:
+    return user_id in _admin_cache.admins()
@@ -30,7 +30,12 @@ def load_cmds() -> OrderedDict:
 
 
 if __name__ == "__main__":
-    from .types import HelpWorker
-
-    worker = HelpWorker(load_cmds())
-    worker.start(ROUTING_KEY, worker.callback)
+    from os import path
+    from . import manifest
+
+    manifest.main(
+        ROUTING_KEY,
+        load_cmds,
+        path.join(path.dirname(__file__), "help_manifest.json"),
+        [path.dirname(path.abspath(__file__))],
+    )
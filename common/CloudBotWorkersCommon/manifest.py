@@ -0,0 +1,170 @@
+"""
+Help messages of a command tree serialized to JSON, so help workers can answer
+without importing the command modules and their dependencies.
+The manifest is built with the image. Environment variables that change the help
+(defaults shown in help, the variables enabling command groups) are not known
+then, they are written as `${NAME}` and filled in when the manifest is loaded.
+The manifest records a fingerprint of the command sources,
+a manifest with a different fingerprint is stale.
+"""
+from os import path
+from os import environ
+from typing import Dict
+from typing import List
+from typing import Iterable
+from typing import Optional
+
+
+def fingerprint(sources: Iterable[str]) -> str:
+    """Hash of the `.py` files under the `sources` directories."""
+    from os import walk
+    from hashlib import sha256
+
+    digest = sha256()
+    for source in sorted(sources):
+        for root, dirs, files in walk(source):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for filename in sorted(f for f in files if f.endswith(".py")):
+                filepath = path.join(root, filename)
+                digest.update(path.relpath(filepath, source).encode())
+                with open(filepath, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+class HelpManifest:
+    """Same help messages as `utils.CommandTable`, without the commands."""
+
+    def __init__(self, groups: List[str], messages: Dict[str, str], source_hash: str):
+        self.groups = groups
+        self.messages = messages
+        self.source_hash = source_hash
+
+    @classmethod
+    def from_table(cls, table, source_hash: str) -> "HelpManifest":
+        groups = [p[0] for p in table.commands if len(p) == 1]
+        messages = {" ".join(p): table.help(p) for p in table.commands}
+        return cls(groups, messages, source_hash)
+
+    @classmethod
+    def read(cls, filepath: str) -> "HelpManifest":
+        from json import load
+
+        with open(filepath) as f:
+            manifest = load(f)
+        return cls(manifest["groups"], manifest["messages"], manifest["source_hash"])
+
+    def write(self, filepath: str) -> None:
+        from json import dump
+
+        with open(filepath, "w") as f:
+            dump(
+                {
+                    "source_hash": self.source_hash,
+                    "groups": self.groups,
+                    "messages": self.messages,
+                },
+                f,
+                indent=1,
+            )
+
+    def resolve(self, groups: Dict[str, str] = None) -> "HelpManifest":
+        """
+        Manifest with `${NAME}` filled in from the environment, limited to
+        the groups whose variable in `groups` (group name to variable) is set.
+        """
+        from string import Template
+
+        enabled = [
+            g
+            for g in self.groups
+            if not groups or g not in groups or environ.get(groups[g])
+        ]
+        messages = {
+            cmd: Template(msg).safe_substitute(environ)
+            for cmd, msg in self.messages.items()
+            if cmd.split()[0] in enabled
+        }
+        return HelpManifest(enabled, messages, self.source_hash)
+
+    def get_help_msg(self, cmd: str) -> str:
+        from .utils import _get_main_help_msg
+
+        cmds = cmd.split()
+        assert cmds[0] == "help"
+        if len(cmds) == 1:
+            return _get_main_help_msg(dict.fromkeys(self.groups))
+        return self.messages[" ".join(cmds[1:])]
+
+
+def load(filepath: str, source_hash: str) -> Optional[HelpManifest]:
+    """Manifest at `filepath`, `None` if it is missing, invalid or stale."""
+    try:
+        manifest = HelpManifest.read(filepath)
+    except (OSError, ValueError, KeyError):
+        print(f"help manifest {filepath} is missing or invalid")
+        return None
+    if manifest.source_hash != source_hash:
+        print(f"help manifest {filepath} is stale")
+        return None
+    return manifest
+
+
+def build(
+    filepath: str,
+    load_cmds: callable,
+    source_hash: str,
+    env: Iterable[str] = (),
+    groups: Dict[str, str] = None,
+) -> HelpManifest:
+    """
+    Writes the manifest of every group returned by `load_cmds()`, with each
+    variable in `env` set to `${NAME}` and the variables in `groups` set.
+    """
+    from .utils import CommandTable
+
+    for name in env:
+        environ[name] = f"${{{name}}}"
+    for name in (groups or {}).values():
+        environ[name] = "1"
+    manifest = HelpManifest.from_table(CommandTable(load_cmds()), source_hash)
+    manifest.write(filepath)
+    print(f"wrote help manifest {filepath}")
+    return manifest
+
+
+def main(
+    routing_key: str,
+    load_cmds: callable,
+    filepath: str,
+    sources: Iterable[str],
+    env: Iterable[str] = (),
+    groups: Dict[str, str] = None,
+) -> None:
+    """
+    Entrypoint of help workers.
+    `--build-manifest` writes the manifest (run when the image is built),
+    `--check-manifest` exits with 1 if it is missing or stale.
+    Otherwise help is served from the manifest only, `load_cmds` is not called.
+    """
+    from sys import argv
+    from .types import HelpWorker
+
+    source_hash = fingerprint(sources)
+    if "--build-manifest" in argv[1:]:
+        build(filepath, load_cmds, source_hash, env, groups)
+        return
+    if "--check-manifest" in argv[1:]:
+        raise SystemExit(0 if load(filepath, source_hash) else 1)
+
+    try:
+        manifest = HelpManifest.read(filepath)
+    except (OSError, ValueError, KeyError) as err:
+        raise SystemExit(
+            f"could not read help manifest {filepath}: {repr(err)}, "
+            "build it with --build-manifest"
+        )
+    if manifest.source_hash != source_hash:
+        print(f"help manifest {filepath} is stale, rebuild it with --build-manifest")
+    worker = HelpWorker(table=manifest.resolve(groups))
+    worker.start(routing_key, worker.callback)
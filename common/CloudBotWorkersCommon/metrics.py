@@ -0,0 +1,252 @@
+"""
+In-process counters, gauges and histograms.
+Served in the Prometheus text format by `start_http_server`.
+"""
+from time import perf_counter
+from typing import Dict
+from typing import List
+from typing import Tuple
+from threading import Lock
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = Lock()
+        self._values: Dict[Tuple, float] = {}
+
+    @staticmethod
+    def _key(labels: dict) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format(name: str, key: Tuple, value: float) -> str:
+        if not key:
+            return f"{name} {value}"
+        labels = ",".join(f'{k}="{_escape(v)}"' for k, v in key)
+        return f"{name}{{{labels}}} {value}"
+
+    def _samples(self) -> list:
+        return [self._format(self.name, k, v) for k, v in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            lines += self._samples()
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _samples(self) -> list:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, bucket_count in zip(bounds, counts + [count]):
+                bucket_key = key + (("le", bound),)
+                samples.append(
+                    self._format(f"{self.name}_bucket", bucket_key, bucket_count)
+                )
+            samples.append(self._format(f"{self.name}_sum", key, total))
+            samples.append(self._format(f"{self.name}_count", key, count))
+        return samples
+
+
+_registry_lock = Lock()
+_registry: Dict[str, _Metric] = {}
+
+
+def _get_or_create(cls, name: str, help: str, **kwargs) -> _Metric:
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, help, **kwargs)
+        return _registry[name]
+
+
+def counter(name: str, help: str) -> Counter:
+    return _get_or_create(Counter, name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    return _get_or_create(Gauge, name, help)
+
+
+def histogram(name: str, help: str, buckets: Tuple = DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, help, buckets=buckets)
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def start_http_server(port: int) -> None:
+    """Serve `render()` at `/metrics` from a daemon thread."""
+    from threading import Thread
+    from http.server import ThreadingHTTPServer
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"serving metrics on :{port}/metrics")
+
+
+_STAGE_SECONDS = histogram("job_stage_seconds", "Seconds spent in job stages.")
+_STAGE_BYTES = counter("job_stage_bytes_total", "Bytes moved in job stages.")
+_STAGE_PEAK_RSS = gauge(
+    "job_stage_peak_rss_bytes", "Peak resident memory in the last run of a stage."
+)
+
+
+def _rss() -> int:
+    """Current resident memory, peak of the process if /proc is not available."""
+    try:
+        from os import sysconf
+
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        from resource import getrusage
+        from resource import RUSAGE_SELF
+
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    """One stage of a `Trace`."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.nbytes = 0
+        self.peak_rss = _rss()
+
+    def add_bytes(self, nbytes: int) -> None:
+        self.nbytes += nbytes
+
+    def _sample(self, done) -> None:
+        while not done.wait(0.1):
+            self.peak_rss = max(self.peak_rss, _rss())
+        self.peak_rss = max(self.peak_rss, _rss())
+
+
+class Trace:
+    """
+    Wall time, bytes moved and peak resident memory of the stages of a job.
+    Stages are also recorded in the `job_stage_*` metrics.
+    """
+
+    def __init__(self, job: str):
+        self.job = job
+        self.spans: List[Span] = []
+
+    @contextmanager
+    def span(self, name: str, stage: str = None):
+        """
+        `name` is shown in the summary, the metrics are labeled with `stage`
+        (`name` by default), which must come from a fixed set of names.
+        """
+        from threading import Event
+        from threading import Thread
+
+        span = Span(name)
+        done = Event()
+        sampler = Thread(target=span._sample, args=(done,), daemon=True)
+        sampler.start()
+        start = perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = perf_counter() - start
+            done.set()
+            sampler.join()
+            self.spans.append(span)
+            stage = stage or name
+            _STAGE_SECONDS.observe(span.seconds, job=self.job, stage=stage)
+            _STAGE_BYTES.inc(span.nbytes, job=self.job, stage=stage)
+            _STAGE_PEAK_RSS.set(span.peak_rss, job=self.job, stage=stage)
+
+    def summary(self) -> str:
+        mb = 1024 * 1024
+        width = max([len(span.name) for span in self.spans] + [5])
+        lines = [f"{'stage':<{width}} {'seconds':>9} {'MB':>9} {'peak RSS MB':>12}"]
+        for span in self.spans:
+            lines.append(
+                f"{span.name:<{width}} {span.seconds:>9.2f} "
+                f"{span.nbytes / mb:>9.1f} {span.peak_rss / mb:>12.1f}"
+            )
+        return "\n".join(lines)
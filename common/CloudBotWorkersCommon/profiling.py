@@ -0,0 +1,89 @@
+"""
+Run a command under cProfile and tracemalloc, see `Worker._invoke_cmd`.
+"""
+from threading import Lock
+from contextlib import contextmanager
+
+
+# hidden token, removed from the command before it is parsed
+PROFILE_FLAG = "--profile"
+
+# tracemalloc peak and snapshots are process wide, profiles run one at a time
+_profile_lock = Lock()
+
+
+def strip_flag(tokens: list) -> tuple:
+    """`tokens` without `PROFILE_FLAG` and whether it was given."""
+    stripped = [token for token in tokens if token != PROFILE_FLAG]
+    return stripped, len(stripped) != len(tokens)
+
+
+class Profile:
+    """
+    Hot functions and allocation sites of the code run in `run()`.
+    Only the calling thread is profiled, allocations are process wide and
+    include other commands running meanwhile. A profile waits for the one
+    running in another thread to finish.
+    """
+
+    def __init__(self, top: int = 15):
+        self.top = top
+        self.stats = None
+        self.allocations = []
+        self.peak = 0
+
+    @contextmanager
+    def run(self):
+        import tracemalloc
+        from cProfile import Profile as CProfile
+        from pstats import Stats
+
+        with _profile_lock:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            start = tracemalloc.take_snapshot()
+            profiler = CProfile()
+            profiler.enable()
+            try:
+                yield self
+            finally:
+                profiler.disable()
+                end = tracemalloc.take_snapshot()
+                _, self.peak = tracemalloc.get_traced_memory()
+                if started:
+                    tracemalloc.stop()
+                self.stats = Stats(profiler)
+                self.allocations = end.compare_to(start, "lineno")[: self.top]
+
+    def _functions(self) -> list:
+        """(cumulative seconds, own seconds, calls, location) by cumulative time."""
+        rows = []
+        for (filename, line, name), stat in self.stats.stats.items():
+            _, calls, own, total, _ = stat
+            rows.append((total, own, calls, f"{_short(filename)}:{line}({name})"))
+        return sorted(rows, reverse=True)[: self.top]
+
+    def report(self) -> str:
+        mb = 1024 * 1024
+        lines = [f"{'cum s':>8} {'own s':>8} {'calls':>8}  function"]
+        for total, own, calls, location in self._functions():
+            lines.append(f"{total:>8.3f} {own:>8.3f} {calls:>8}  {location}")
+        lines += ["", f"peak traced memory {self.peak / mb:.1f} MB", ""]
+        lines.append(f"{'MB':>8} {'blocks':>8}  allocated at")
+        for stat in self.allocations:
+            frame = stat.traceback[0]
+            lines.append(
+                f"{stat.size_diff / mb:>8.2f} {stat.count_diff:>8}  "
+                f"{_short(frame.filename)}:{frame.lineno}"
+            )
+        return "\n".join(lines)
+
+
+def _short(filename: str) -> str:
+    """Path from the package directory on, the interpreter prefix is not useful."""
+    import re
+
+    return re.sub(r"^.*/(site-packages|dist-packages|lib/python[\d.]+)/", "", filename)
@@ -1,14 +1,247 @@
+import atexit
+from os import getpid
+from collections import deque
 from typing import Any
 from typing import Dict
 from json import loads
+from functools import lru_cache
+from threading import Lock
+from threading import Thread
 
-from requests import get
-from requests import post
+from requests import Session
 
 from . import config
+from . import metrics
 import time
 
 
+# seconds to wait for slack before giving up on a request
+_TIMEOUT = 30
+
+_REQUEST_SECONDS = metrics.histogram(
+    "slack_request_seconds", "Seconds spent in slack api requests."
+)
+_RATE_LIMITED = metrics.counter(
+    "slack_rate_limited_total", "Slack api requests rejected with 429."
+)
+
+
+@lru_cache(maxsize=None)
+def get_session() -> Session:
+    """
+    Keep-alive session shared by the process, so posts reuse connections
+    instead of paying for a new TLS handshake each time.
+    Connection errors and 5xx responses are retried with backoff.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        # 429 is handled by the dispatcher so it can throttle the channel
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=max(10, config.WORKER_CONCURRENCY), max_retries=retry
+    )
+    session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class _TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available."""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """No tokens for `seconds`, used to honor `Retry-After`."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self._rate
+
+
+class _Limits:
+    """Token buckets per channel and per workspace, shared by the process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._channels = {}
+        self._workspaces = {}
+
+    def _bucket(self, buckets: dict, key: str, rate: float) -> _TokenBucket:
+        try:
+            return buckets[key]
+        except KeyError:
+            return buckets.setdefault(key, _TokenBucket(rate, max(1.0, rate * 3)))
+
+    def wait_time(self, response: "Response", data: Dict[str, Any]) -> float:
+        """Seconds until `data` may be posted, takes the tokens when it is 0."""
+        with self._lock:
+            buckets = (
+                self._bucket(
+                    self._channels, data.get("channel"), config.SLACK_CHANNEL_RATE
+                ),
+                self._bucket(
+                    self._workspaces,
+                    response.event.get("team"),
+                    config.SLACK_WORKSPACE_RATE,
+                ),
+            )
+            wait = max(bucket.wait_time() for bucket in buckets)
+            if wait == 0:
+                for bucket in buckets:
+                    bucket.take()
+            return wait
+
+    def pause(self, data: Dict[str, Any], seconds: float) -> None:
+        with self._lock:
+            self._channels[data.get("channel")].pause(seconds)
+
+
+_limits = _Limits()
+
+
+def _retry_after(response) -> float:
+    """Seconds slack asked us to wait, `None` if the post was not rate limited."""
+    if response.status_code != 429:
+        return None
+    return float(response.headers.get("Retry-After", 1))
+
+
+class _Dispatcher:
+    """
+    Posts queued messages from a daemon thread within the rate limits.
+    Messages to the same thread that pile up while waiting for the limits
+    are combined into one post, order within a thread is kept:
+    a message is only added to the last pending post of its thread,
+    and only when both are broadcast or both are not.
+    """
+
+    # slack truncates longer messages
+    MAX_COMBINED_LENGTH = 3000
+
+    def __init__(self):
+        from threading import Condition
+
+        self._cond = Condition()
+        self._pid = None
+
+    def submit(self, response: "Response", data: Dict[str, Any]) -> None:
+        with self._cond:
+            # forked pool processes do not inherit the thread, start their own
+            if self._pid != getpid():
+                self._pid = getpid()
+                self._pending = deque()
+                self._last = {}
+                self._busy = False
+                Thread(target=self._run, name="slack-sender", daemon=True).start()
+
+            key = self._key(data)
+            last = self._last.get(key)
+            if (
+                last is not None
+                and key[1] is not None
+                and last[1].get("reply_broadcast") == data.get("reply_broadcast")
+                and len(last[1]["text"]) + len(data["text"]) < self.MAX_COMBINED_LENGTH
+            ):
+                last[1]["text"] = f"{last[1]['text']}\n{data['text']}"
+                return
+            entry = (response, dict(data))
+            self._pending.append(entry)
+            self._last[key] = entry
+            self._cond.notify_all()
+
+    @staticmethod
+    def _key(data: Dict[str, Any]) -> tuple:
+        return (data.get("channel"), data.get("thread_ts"))
+
+    def _next(self) -> tuple:
+        """First pending entry whose channel is not rate limited."""
+        with self._cond:
+            while True:
+                wait = None
+                for entry in self._pending:
+                    entry_wait = _limits.wait_time(*entry)
+                    if entry_wait == 0:
+                        self._pending.remove(entry)
+                        key = self._key(entry[1])
+                        if self._last.get(key) is entry:
+                            del self._last[key]
+                        self._busy = True
+                        return entry
+                    wait = entry_wait if wait is None else min(wait, entry_wait)
+                self._busy = False
+                self._cond.notify_all()
+                self._cond.wait(wait)
+
+    def _run(self) -> None:
+        while True:
+            response, data = self._next()
+            try:
+                seconds = _retry_after(response._post_now(data))
+                if seconds is not None:
+                    _limits.pause(data, seconds)
+                    with self._cond:
+                        self._pending.appendleft((response, data))
+            except Exception as err:
+                print(f"slack post failed: {repr(err)}")
+
+    def post(self, response: "Response", data: Dict[str, Any], retries: int = 5):
+        """Posts `data` in the calling thread, waiting for the rate limits."""
+        for _ in range(retries):
+            wait = _limits.wait_time(response, data)
+            while wait > 0:
+                time.sleep(wait)
+                wait = _limits.wait_time(response, data)
+            result = response._post_now(data)
+            seconds = _retry_after(result)
+            if seconds is None:
+                break
+            _limits.pause(data, seconds)
+        return result
+
+    def flush(self) -> None:
+        """Blocks until all queued messages are posted."""
+        with self._cond:
+            if self._pid != getpid():
+                return
+            while self._pending or self._busy:
+                self._cond.wait()
+
+
+_dispatcher = _Dispatcher()
+atexit.register(_dispatcher.flush)
+
+
+def flush() -> None:
+    """Wait for messages queued with `SLACK_ASYNC_SEND`."""
+    _dispatcher.flush()
+
+
 class Response:
     """
     Determines the destination for response based on the `event`.
@@ -21,6 +254,9 @@ class Response:
             "Authorization": f"Bearer {config.SLACK_API_BOT_ACCESS_TOKEN}"
         }
         self.long_job = False
+        self.send_seconds = 0.0
+        self._in_thread = False
+        self._thread_checked_at = None
 
     def send(self, message: str, broadcast: bool = False):
         """
@@ -28,55 +264,154 @@ class Response:
         If the latest message is not the command run,
         then the response is posted in a thread.
         This is needed for long running jobs.
+        Time spent here is added to `send_seconds`.
         """
-        if (not "channel_type" in self.event) or (
-            self.long_job and self._check_post_to_thread()
-        ):
-            return self.post_to_thread(
-                message,
-                self.event["event_ts"],
-                self.event["channel"],
-                broadcast=broadcast,
-            )
-        else:
-            return self.post_to_user(message, self.event["channel"])
+        start = time.perf_counter()
+        try:
+            if (not "channel_type" in self.event) or (
+                self.long_job and self._post_to_thread()
+            ):
+                return self.post_to_thread(
+                    message,
+                    self.event["event_ts"],
+                    self.event["channel"],
+                    broadcast=broadcast,
+                )
+            else:
+                return self.post_to_user(message, self.event["channel"])
+        finally:
+            self.send_seconds += time.perf_counter() - start
 
     def post_to_thread(
         self, message: str, ts: str, channel: str = None, broadcast: bool = False
     ):
-        response = post(
-            config.SLACK_API_MESSAGE_POST,
-            headers=self.auth_headers,
-            data={
+        return self._post(
+            {
                 "channel": channel,
                 "text": message,
                 "thread_ts": ts,
                 "reply_broadcast": broadcast,
-            },
+            }
         )
-        return response
 
     def post_to_channel(self, message: str, channel: str):
-        response = post(
-            config.SLACK_API_MESSAGE_POST,
-            headers=self.auth_headers,
-            data={"channel": channel, "text": message},
-        )
-        return response
+        return self._post({"channel": channel, "text": message})
 
     def post_to_user(self, message: str, user_channel: str):
-        response = post(
-            config.SLACK_API_MESSAGE_POST,
-            headers=self.auth_headers,
-            data={"channel": user_channel, "text": message},
-        )
+        return self._post({"channel": user_channel, "text": message})
+
+    def _post(self, data: Dict[str, Any]):
+        """
+        Posts are rate limited per channel and workspace.
+        With `SLACK_ASYNC_SEND` the message is queued for the background sender
+        and `None` is returned right away.
+        """
+        if config.SLACK_ASYNC_SEND:
+            return _dispatcher.submit(self, data)
+        return _dispatcher.post(self, data)
+
+    def _post_now(self, data: Dict[str, Any]):
+        with _REQUEST_SECONDS.time(method="chat.postMessage"):
+            response = get_session().post(
+                config.SLACK_API_MESSAGE_POST,
+                headers=self.auth_headers,
+                data=data,
+                timeout=_TIMEOUT,
+            )
+        if response.status_code == 429:
+            _RATE_LIMITED.inc(method="chat.postMessage")
         return response
 
+    def _post_to_thread(self) -> bool:
+        """
+        Once a job posts to its thread it stays there, until then the channel
+        history is checked at most every `SLACK_THREAD_CHECK_INTERVAL` seconds.
+        """
+        if self._in_thread:
+            return True
+        now = time.monotonic()
+        if (
+            self._thread_checked_at is None
+            or now - self._thread_checked_at >= config.SLACK_THREAD_CHECK_INTERVAL
+        ):
+            self._thread_checked_at = now
+            self._in_thread = self._check_post_to_thread()
+        return self._in_thread
+
     def _check_post_to_thread(self):
-        response = get(
+        response = get_session().get(
             config.SLACK_API_CONVERSATION_HISTORY,
             headers=self.auth_headers,
             params={"channel": self.event["channel"], "limit": 1},
+            timeout=_TIMEOUT,
         )
         response = loads(response.content)
         return not response["messages"][0]["ts"] == self.event["ts"]
+
+
+class UserDirectory:
+    """
+    Slack user profiles cached for `SLACK_USER_CACHE_TTL` seconds.
+    A stale profile is returned when slack can not be reached.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._users = {}
+
+    @property
+    def _auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {config.SLACK_API_BOT_ACCESS_TOKEN}"}
+
+    def _store(self, users: list) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for user in users:
+                self._users[user["id"]] = (user, now)
+
+    def get(self, user_id: str) -> Dict[str, Any]:
+        cached = self._users.get(user_id)
+        if cached and time.monotonic() - cached[1] < config.SLACK_USER_CACHE_TTL:
+            return cached[0]
+        try:
+            response = get_session().get(
+                config.SLACK_API_USER_INFO,
+                headers=self._auth_headers,
+                params={"user": user_id},
+                timeout=_TIMEOUT,
+            )
+            user = response.json()["user"]
+        except Exception:
+            if cached:
+                return cached[0]
+            raise
+        self._store([user])
+        return user
+
+    def warm(self) -> None:
+        """Load all users with `users.list`."""
+        cursor = None
+        while True:
+            params = {"limit": 200}
+            if cursor:
+                params["cursor"] = cursor
+            response = get_session().get(
+                config.SLACK_API_USERS_LIST,
+                headers=self._auth_headers,
+                params=params,
+                timeout=_TIMEOUT,
+            )
+            response = response.json()
+            self._store(response["members"])
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+        print(f"loaded {len(self._users)} slack users")
+
+
+users = UserDirectory()
+
+
+def get_username(user_id: str) -> str:
+    """`real_name` of the user, lowercase with underscores."""
+    return users.get(user_id)["real_name"].lower().replace(" ", "_")
@@ -1,29 +1,124 @@
 from json import loads
 from typing import Tuple
+from functools import partial
+from concurrent.futures import Future
+from concurrent.futures import Executor
+from concurrent.futures import BrokenExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 from click import Group
 from requests import codes
 
+from . import metrics
 from .slack import Response as SlackResponse
 
 
+_QUEUE_WAIT = metrics.histogram(
+    "worker_queue_wait_seconds", "Seconds from the slack event to its command."
+)
+_PARSE_SECONDS = metrics.histogram(
+    "worker_parse_seconds", "Seconds spent parsing commands."
+)
+_EXECUTION_SECONDS = metrics.histogram(
+    "worker_execution_seconds", "Seconds spent running commands."
+)
+_SLACK_SEND_SECONDS = metrics.histogram(
+    "worker_slack_send_seconds", "Seconds each command spent sending to slack."
+)
+_COMMANDS = metrics.counter("worker_commands_total", "Commands received.")
+_ERRORS = metrics.counter("worker_errors_total", "Commands that failed.")
+
+
+def _observe_queue_wait(event: dict, command: str) -> None:
+    from time import time
+
+    if "event_ts" in event:
+        _QUEUE_WAIT.observe(time() - float(event["event_ts"]), command=command)
+
+
+# callback inherited by forked pool processes, see `Worker._create_executor`
+_process_callback = None
+
+
+def _init_process_pool(callback: callable) -> None:
+    global _process_callback
+    _process_callback = callback
+
+
+def _run_process_callback(method, properties, body) -> None:
+    _process_callback(None, method, properties, body)
+
+
+class _Pool:
+    """
+    Executor made by `create`, replaced by a new one once it is broken
+    (a process of a process pool died, e.g. killed for using too much memory).
+    Only used on the connection thread.
+    """
+
+    def __init__(self, create: callable):
+        self._create = create
+        self.executor = create()
+
+    def submit(self, fn: callable, *args) -> Future:
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenExecutor:
+            self.restart(self.executor)
+            return self.executor.submit(fn, *args)
+
+    def restart(self, broken: Executor) -> None:
+        """Replaces `broken`, unless it was replaced already."""
+        if self.executor is not broken:
+            return
+        print("worker pool is broken, starting a new one")
+        self.executor = self._create()
+        broken.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
 class Worker:
     def __init__(self, cmd_grp: Group):
+        from .utils import CommandTable
+
         self._grp = cmd_grp
+        self._table = CommandTable({cmd_grp.name: cmd_grp})
 
     def _invoke_cmd(self, cmd: str, slack_response: SlackResponse) -> Tuple[bool, str]:
         from click import Context
         from click.exceptions import MissingParameter
+        from contextlib import nullcontext
+        from . import config
+        from .profiling import Profile
+        from .profiling import strip_flag
+
+        tokens, profiled = strip_flag(cmd.split())
+        profile = None
+        if profiled or config.WORKER_PROFILE:
+            profile = Profile(config.WORKER_PROFILE_TOP)
+        path = self._table.resolve(tokens)
+        command = " ".join(path)
+        if self._table.is_long_job(path):
+            slack_response.long_job = True
+        _COMMANDS.inc(command=command)
+        _observe_queue_wait(slack_response.event, command)
 
         ctx = Context(self._grp, info_name=self._grp.name, obj={})
         ctx.obj["slack_response"] = slack_response
         try:
-            self._grp.parse_args(ctx, cmd.split()[1:])
-            self._grp.invoke(ctx)
+            with profile.run() if profile else nullcontext():
+                with _PARSE_SECONDS.time(command=command):
+                    self._grp.parse_args(ctx, tokens[1:])
+                with _EXECUTION_SECONDS.time(command=command):
+                    self._grp.invoke(ctx)
         except MissingParameter as err:
+            _ERRORS.inc(command=command, error=type(err).__name__)
             msg = f":warning: Something went wrong.\n```{err.format_message()}```"
             slack_response.send(msg, False)
         except Exception as err:
+            _ERRORS.inc(command=command, error=type(err).__name__)
             err = repr(err).split("\n")
             if len(err) > 5:
                 err_start = "\n".join(err[:2])
@@ -33,43 +128,235 @@ class Worker:
                 err = "\n".join(err)
             msg = f":warning: Something went wrong. Please refer help.\n```{err}```"
             slack_response.send(msg, False)
+        if profile:
+            self._send_profile(profile, command, slack_response)
+        _SLACK_SEND_SECONDS.observe(slack_response.send_seconds, command=command)
+
+    @staticmethod
+    def _send_profile(profile, command: str, slack_response: SlackResponse):
+        """Profile report as a reply in the thread of the command."""
+        event = slack_response.event
+        slack_response.post_to_thread(
+            f"profile of `{command}`\n```{profile.report()}```",
+            event["event_ts"],
+            event["channel"],
+        )
 
     def callback(self, ch, method, properties, body):
         event = loads(body)["event"]
         self._invoke_cmd(event["user_cmd"], SlackResponse(event))
 
-    def start(self, routing_key: str, callback: callable):
+    def _create_executor(self, callback: callable, concurrency: int) -> Executor:
+        from . import config
+
+        if config.WORKER_POOL == "process":
+            from multiprocessing import get_context
+
+            # fork so the pool inherits `callback` (click groups do not pickle)
+            return ProcessPoolExecutor(
+                concurrency,
+                mp_context=get_context("fork"),
+                initializer=_init_process_pool,
+                initargs=(callback,),
+            )
+        from concurrent.futures import ThreadPoolExecutor
+
+        return ThreadPoolExecutor(concurrency, thread_name_prefix="worker")
+
+    def _submit(self, pool: _Pool, callback: callable, ch, method, properties, body):
+        """
+        Runs on the connection thread and hands the message to `pool`.
+        The channel is not passed on, it is only safe to use on this thread.
+        """
+        if isinstance(pool.executor, ProcessPoolExecutor):
+            future = pool.submit(_run_process_callback, method, properties, body)
+        else:
+            future = pool.submit(callback, None, method, properties, body)
+        future.add_done_callback(
+            partial(self._on_done, ch, method, pool, pool.executor)
+        )
+
+    def _on_done(self, ch, method, pool: _Pool, executor: Executor, future: Future):
+        """Runs on a pool thread, acks are scheduled back on the connection thread."""
+        err = future.exception()
+        ch.connection.add_callback_threadsafe(
+            partial(self._ack, ch, method.delivery_tag, err, method.redelivered)
+        )
+        if isinstance(err, BrokenExecutor):
+            ch.connection.add_callback_threadsafe(partial(pool.restart, executor))
+
+    @staticmethod
+    def _ack(ch, delivery_tag: int, err: Exception = None, redelivered: bool = False):
+        """
+        Errors of commands are reported in `_invoke_cmd`, a failed future is
+        a failure of the worker. A message that was in a broken pool is requeued
+        once, if it breaks the pool again (e.g. it is killed for memory) or
+        fails otherwise it is rejected, dead-lettered if the queue has one.
+        """
+        if err is None:
+            ch.basic_ack(delivery_tag)
+            return
+        requeue = isinstance(err, BrokenExecutor) and not redelivered
+        action = "requeued" if requeue else "rejected"
+        print(f"message {delivery_tag} failed, {action}: {repr(err)}")
+        ch.basic_nack(delivery_tag, requeue=requeue)
+
+    @staticmethod
+    def _declare_queue(channel, routing_key: str) -> str:
+        """
+        Exclusive anonymous queue by default, every worker gets every message.
+        With `WORKER_SHARED_QUEUES` workers for the same `routing_key` consume
+        from one named durable queue and split the messages between them.
+        """
+        from . import config
+
+        if not config.WORKER_SHARED_QUEUES:
+            return channel.queue_declare("", exclusive=True).method.queue
+        queue_name = Worker._shared_queue_name(routing_key)
+        return channel.queue_declare(queue_name, durable=True).method.queue
+
+    @staticmethod
+    def _shared_queue_name(routing_key: str) -> str:
         from . import config
+
+        return f"{config.EXCHANGE_NAME}.{routing_key.rstrip('.#')}"
+
+    @staticmethod
+    def _serve_metrics() -> None:
+        from . import config
+
+        if config.METRICS_PORT:
+            metrics.start_http_server(config.METRICS_PORT)
+
+    def start(self, routing_key: str, callback: callable):
+        """
+        Consume messages for `routing_key`.
+        By default `callback` runs inline and messages are acked on delivery.
+        With `WORKER_CONCURRENCY` > 0 messages are handed to a thread
+        (or process, `WORKER_POOL=process`) pool, at most `WORKER_PREFETCH_COUNT`
+        are in flight and each is acked only after `callback` returns.
+        Shared queues always use the pool so unfinished work is redelivered.
+        With `WORKER_LONG_CONCURRENCY` > 0 long jobs run in a separate lane.
+        """
         from . import amqp_connection
 
         print(f"initializing worker for {routing_key}")
-        channel = amqp_connection.channel()
+        self._serve_metrics()
+        self._consume(amqp_connection.channel(), routing_key, callback)
+
+    def _consume(self, channel, routing_key: str, callback: callable):
+        """Declare, bind and consume on `channel` until it stops consuming."""
+        from . import config
+
         channel.exchange_declare(exchange=config.EXCHANGE_NAME, exchange_type="topic")
 
-        queue_name = channel.queue_declare("", exclusive=True).method.queue
+        queue_name = self._declare_queue(channel, routing_key)
         channel.queue_bind(
             exchange=config.EXCHANGE_NAME, queue=queue_name, routing_key=routing_key
         )
-        channel.basic_consume(
-            queue=queue_name, on_message_callback=callback, auto_ack=True
-        )
+        concurrency = config.WORKER_CONCURRENCY
+        if config.WORKER_SHARED_QUEUES:
+            concurrency = max(concurrency, 1)
+        pools = []
+        if concurrency > 0:
+            pools.append(_Pool(partial(self._create_executor, callback, concurrency)))
+            channel.basic_qos(
+                prefetch_count=config.WORKER_PREFETCH_COUNT or concurrency
+            )
+            on_message = partial(self._submit, pools[0], callback)
+            if config.WORKER_LONG_CONCURRENCY > 0:
+                # publishes to the long queue are confirmed before the ack
+                channel.confirm_delivery()
+                long_queue, long_pool = self._consume_long_lane(
+                    channel, queue_name, callback
+                )
+                pools.append(long_pool)
+                on_message = partial(self._route, long_queue, on_message)
+            channel.basic_consume(queue=queue_name, on_message_callback=on_message)
+        else:
+            channel.basic_consume(
+                queue=queue_name, on_message_callback=callback, auto_ack=True
+            )
 
         print(" [*] Waiting for work. To exit press CTRL+C")
-        channel.start_consuming()
+        try:
+            channel.start_consuming()
+        finally:
+            for pool in pools:
+                pool.shutdown()
+
+    def _consume_long_lane(self, channel, queue_name: str, callback: callable):
+        """
+        Long jobs are moved to a second queue, consumed on its own channel by
+        a pool of `WORKER_LONG_CONCURRENCY`, so they can not take the prefetch
+        slots and threads interactive commands need.
+        """
+        from . import config
+
+        concurrency = config.WORKER_LONG_CONCURRENCY
+        long_channel = channel.connection.channel()
+        if config.WORKER_SHARED_QUEUES:
+            result = long_channel.queue_declare(f"{queue_name}.long", durable=True)
+        else:
+            result = long_channel.queue_declare("", exclusive=True)
+        pool = _Pool(partial(self._create_executor, callback, concurrency))
+        long_channel.basic_qos(prefetch_count=concurrency)
+        long_channel.basic_consume(
+            queue=result.method.queue,
+            on_message_callback=partial(self._submit, pool, callback),
+        )
+        return result.method.queue, pool
+
+    def _route(self, long_queue: str, submit: callable, ch, method, properties, body):
+        """
+        Runs on the connection thread, long jobs are republished to `long_queue`.
+        The channel confirms publishes, the original is acked once the broker has
+        the copy; if it does not, the job runs in this lane instead.
+        """
+        from pika.exceptions import NackError
+        from pika.exceptions import UnroutableError
+
+        try:
+            cmd = loads(body)["event"]["user_cmd"]
+            long = self._table.is_long_job(self._table.resolve(cmd.split()))
+        except Exception:
+            # fails again in `callback`, where the error is reported
+            long = False
+        if not long:
+            return submit(ch, method, properties, body)
+        try:
+            ch.basic_publish(
+                "", long_queue, body, properties=properties, mandatory=True
+            )
+        except (NackError, UnroutableError) as err:
+            print(f"could not move message to {long_queue}: {repr(err)}")
+            return submit(ch, method, properties, body)
+        ch.basic_ack(method.delivery_tag)
 
 
 class HelpWorker(Worker):
-    def __init__(self, cmd_grps: dict):
+    def __init__(self, cmd_grps: dict = None, table=None):
+        """
+        Help of `cmd_grps`, or of `table` (a `CommandTable` or a
+        `manifest.HelpManifest`), which does not need the commands.
+        """
+        from .utils import CommandTable
+
         self._cmd_grps = cmd_grps
+        self._table = table or CommandTable(cmd_grps)
 
     def callback(self, ch, method, properties, body):
         """Entrypoint for the `help` worker."""
-        from .utils import get_help_msg
-
         event = loads(body)["event"]
+        _COMMANDS.inc(command="help")
+        _observe_queue_wait(event, "help")
         try:
-            msg = get_help_msg(event["user_cmd"], self._cmd_grps)
+            with _EXECUTION_SECONDS.time(command="help"):
+                msg = self._table.get_help_msg(event["user_cmd"])
         except Exception as err:
+            _ERRORS.inc(command="help", error=type(err).__name__)
             msg = ":warning: Something went wrong. Check help to see "
             msg += f"if your command is properly formatted.\n```{repr(err)}```"
-        SlackResponse(event).send(msg)
+        slack_response = SlackResponse(event)
+        slack_response.send(msg)
+        _SLACK_SEND_SECONDS.observe(slack_response.send_seconds, command="help")
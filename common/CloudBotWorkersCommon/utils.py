@@ -1,4 +1,6 @@
+from typing import Dict
 from typing import List
+from typing import Tuple
 from typing import Union
 from typing import Iterable
 
@@ -49,6 +51,72 @@ def get_help_msg(cmd: str, cmd_grps: dict) -> str:
         return f"```{nested_grp_or_cmd.get_help(ctx)}```"
 
 
+class CommandTable:
+    """
+    Command tree of `cmd_grps` compiled once into a flat table that maps
+    command paths, like ("gt", "volume", "preview"), to groups and commands.
+    Help messages are rendered on first use and cached.
+    """
+
+    def __init__(self, cmd_grps: dict):
+        self.commands: Dict[Tuple[str, ...], Union[Group, Command]] = {}
+        for name, grp in cmd_grps.items():
+            self._add((name,), grp)
+        self._main_help = _get_main_help_msg(cmd_grps)
+        self._help: Dict[Tuple[str, ...], str] = {}
+
+    def _add(self, path: Tuple[str, ...], cmd: Union[Group, Command]) -> None:
+        self.commands[path] = cmd
+        if isinstance(cmd, Group):
+            for name, child in cmd.commands.items():
+                self._add(path + (name,), child)
+
+    def resolve(self, names: Iterable[str]) -> Tuple[str, ...]:
+        """
+        Path of the command in `names`, e.g. `gcloud -p x bucket b iam add -m y`
+        resolves to ("gcloud", "bucket", "iam", "add").
+        Names that are not subcommands (options and arguments) are skipped.
+        """
+        path = ()
+        for name in names:
+            if path + (name,) in self.commands:
+                path = path + (name,)
+        return path
+
+    def help(self, path: Tuple[str, ...]) -> str:
+        try:
+            return self._help[path]
+        except KeyError:
+            cmd = self.commands[path]
+            ctx = Context(cmd, info_name=" ".join(path))
+            return self._help.setdefault(path, f"```{cmd.get_help(ctx)}```")
+
+    def is_long_job(self, path: Tuple[str, ...]) -> bool:
+        """Whether the command at `path` or one of its groups is a `long_job`."""
+        return any(
+            getattr(self.commands.get(path[:i]), "long_job", False)
+            for i in range(1, len(path) + 1)
+        )
+
+    def get_help_msg(self, cmd: str) -> str:
+        """Same as `get_help_msg`, from the table."""
+        cmds = cmd.split()
+        assert cmds[0] == "help"
+        if len(cmds) == 1:
+            return self._main_help
+        return self.help(tuple(cmds[1:]))
+
+
+def long_job(cmd: Union[Group, Command]) -> Union[Group, Command]:
+    """
+    Marks a command, or every command of a group, as a long job.
+    Responses of long jobs go to a thread and with `WORKER_LONG_CONCURRENCY`
+    they run in a separate lane, so they do not hold up interactive commands.
+    """
+    cmd.long_job = True
+    return cmd
+
+
 def admin_check(user_id: str) -> str:
     if is_admin(user_id):
         return
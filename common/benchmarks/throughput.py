@@ -0,0 +1,356 @@
+"""
+End-to-end message throughput of `Worker` and `HelpWorker`.
+
+Synthetic Slack events are published at a controlled rate to an in-memory
+stand-in for the AMQP connection. Slack is a local HTTP server and admins come
+from `LOCAL_ADMINS`, so no services are needed. From `common`:
+
+    python -m benchmarks.throughput --count 500 --rate 100 --concurrency 8
+
+With `--concurrency`, echo commands also run next to long jobs (`bench slow`),
+compare `--long-concurrency 0` and `--long-concurrency 2` to see the lanes.
+"""
+
+import os
+import json
+import argparse
+from time import time
+from time import sleep
+from time import perf_counter
+from queue import Queue
+from threading import Lock
+from threading import Thread
+from collections import deque
+from collections import OrderedDict
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
+
+
+class FakeSlack:
+    """Local Slack API that answers every call with `ok` and counts them."""
+
+    def __init__(self, latency: float = 0.0):
+        self.calls = 0
+        self._lock = Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self):
+                with fake._lock:
+                    fake.calls += 1
+                sleep(latency)
+                ts = str(time())
+                body = json.dumps(
+                    {
+                        "ok": True,
+                        "ts": ts,
+                        "messages": [{"ts": ts}],
+                        "user": {"id": "U1", "real_name": "Bench User"},
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._reply()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._reply()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+
+class InMemoryConnection:
+    """
+    Subset of pika's `BlockingConnection`, channels are served by one
+    consuming thread like in pika. Records publish to ack latency per command.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.queues = {}
+        self._events = Queue()
+        self._channels = []
+
+    def channel(self) -> "InMemoryChannel":
+        channel = InMemoryChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback) -> None:
+        self._events.put(("callback", callback))
+
+    def publish(self, cmd: str) -> None:
+        """Thread safe, like a message arriving from the broker."""
+        self._events.put(("message", (cmd, perf_counter(), _event(cmd))))
+
+    def done(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def stop(self) -> None:
+        self._events.put(("stop", None))
+
+    def _record(self, message: tuple) -> None:
+        cmd, published, _ = message
+        self.latencies.setdefault(cmd, []).append(perf_counter() - published)
+
+    def start_consuming(self) -> None:
+        while True:
+            kind, item = self._events.get()
+            if kind == "stop":
+                return
+            if kind == "callback":
+                item()
+            else:
+                self._channels[0].waiting.append(item)
+            for channel in self._channels:
+                channel.deliver()
+
+
+class InMemoryChannel:
+    """Subset of pika's `BlockingChannel` used by `Worker._consume`."""
+
+    def __init__(self, connection: InMemoryConnection):
+        self.connection = connection
+        self.waiting = deque()
+        self._unacked = {}
+        self._prefetch = 0
+        self._auto_ack = False
+        self._callback = None
+        self._tag = 0
+        self._delivering = None
+        self._moved = set()
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def queue_declare(self, queue: str = "", **kwargs):
+        queue = queue or f"bench-{len(self.connection.queues)}"
+        self.connection.queues[queue] = self
+        return SimpleNamespace(method=SimpleNamespace(queue=queue))
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_count: int = 0):
+        self._prefetch = prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack=False):
+        self._callback = on_message_callback
+        self._auto_ack = auto_ack
+
+    def confirm_delivery(self) -> None:
+        pass
+
+    def basic_publish(
+        self, exchange: str, routing_key: str, body, properties=None, mandatory=False
+    ):
+        """Moves the message being delivered to another queue."""
+        self.connection.queues[routing_key].waiting.append(self._delivering)
+        self._moved.add(self._tag)
+
+    def basic_ack(self, delivery_tag: int) -> None:
+        message = self._unacked.pop(delivery_tag)
+        if delivery_tag in self._moved:
+            self._moved.discard(delivery_tag)
+        else:
+            self.connection._record(message)
+
+    def basic_nack(self, delivery_tag: int, requeue: bool = False) -> None:
+        self.basic_ack(delivery_tag)
+
+    def start_consuming(self) -> None:
+        self.connection.start_consuming()
+
+    def stop_consuming(self) -> None:
+        self.connection.stop()
+
+    def deliver(self) -> None:
+        while self.waiting and (
+            self._auto_ack or not self._prefetch or len(self._unacked) < self._prefetch
+        ):
+            self._delivering = self.waiting.popleft()
+            self._tag += 1
+            method = SimpleNamespace(
+                delivery_tag=self._tag, routing_key="bench", redelivered=False
+            )
+            if not self._auto_ack:
+                self._unacked[self._tag] = self._delivering
+            self._callback(self, method, SimpleNamespace(), self._delivering[2])
+            if self._auto_ack:
+                self.connection._record(self._delivering)
+
+
+def _event(cmd: str) -> bytes:
+    ts = str(time())
+    event = {
+        "user_cmd": cmd,
+        "user": "U1",
+        "channel": "D1",
+        "channel_type": "im",
+        "event_ts": ts,
+        "ts": ts,
+    }
+    return json.dumps({"event": event}).encode()
+
+
+def _bench_group():
+    import click
+    from CloudBotWorkersCommon.utils import long_job
+
+    @click.group("bench", help="Benchmark commands.", add_help_option=False)
+    @click.pass_context
+    def bench(ctx, *args, **kwargs):
+        pass
+
+    @bench.command("echo", help="Reply with TEXT.", add_help_option=False)
+    @click.argument("text", type=str)
+    @click.pass_context
+    def echo(ctx, *args, **kwargs):
+        ctx.obj["slack_response"].send(kwargs["text"])
+
+    @bench.command("io", help="Wait like an API call.", add_help_option=False)
+    @click.option("--seconds", "-s", type=float, default=0.05)
+    @click.pass_context
+    def io(ctx, *args, **kwargs):
+        ctx.obj["slack_response"].send("started")
+        sleep(kwargs["seconds"])
+        ctx.obj["slack_response"].send("done")
+
+    @long_job
+    @bench.command("slow", help="Long job, like a transfer.", add_help_option=False)
+    @click.option("--seconds", "-s", type=float, default=1.0)
+    @click.pass_context
+    def slow(ctx, *args, **kwargs):
+        sleep(kwargs["seconds"])
+        ctx.obj["slack_response"].send("done")
+
+    return bench
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_worker(worker, callback, cmds: list, count: int, rate: float, slack):
+    """Publishes `count` messages cycling through `cmds`, results per command."""
+    connection = InMemoryConnection()
+    consumer = Thread(
+        target=worker._consume,
+        args=(connection.channel(), "bench.#", callback),
+        daemon=True,
+    )
+    consumer.start()
+
+    calls = slack.calls
+    start = perf_counter()
+    for i in range(count):
+        if rate:
+            sleep(max(0, start + i / rate - perf_counter()))
+        connection.publish(cmds[i % len(cmds)])
+    while connection.done() < count:
+        sleep(0.01)
+    elapsed = perf_counter() - start
+    connection.stop()
+    consumer.join()
+
+    results = OrderedDict()
+    for cmd in cmds:
+        latencies = connection.latencies[cmd]
+        results[cmd] = OrderedDict(
+            messages_per_s=len(latencies) / elapsed,
+            p50_ms=_percentile(latencies, 50) * 1000,
+            p99_ms=_percentile(latencies, 99) * 1000,
+            slack_calls_per_cmd=(slack.calls - calls) / count,
+        )
+    return results
+
+
+def run(args) -> OrderedDict:
+    slack = FakeSlack(latency=args.slack_latency)
+    os.environ.setdefault("SLACK_API_BOT_ACCESS_TOKEN", "bench")
+    os.environ.setdefault("LOCAL_ADMINS", "U1")
+    os.environ["SLACK_API_MESSAGE_POST"] = f"{slack.url}/chat.postMessage"
+    os.environ["SLACK_API_CONVERSATION_HISTORY"] = f"{slack.url}/conversations.history"
+    os.environ["SLACK_API_USER_INFO"] = f"{slack.url}/users.info"
+    os.environ["WORKER_CONCURRENCY"] = str(args.concurrency)
+    os.environ["WORKER_LONG_CONCURRENCY"] = str(args.long_concurrency)
+    # slack limits would measure the limiter, not the worker
+    os.environ.setdefault("SLACK_CHANNEL_RATE", "1000000")
+    os.environ.setdefault("SLACK_WORKSPACE_RATE", "1000000")
+
+    from CloudBotWorkersCommon.types import Worker
+    from CloudBotWorkersCommon.types import HelpWorker
+
+    grp = _bench_group()
+    worker = Worker(grp)
+    help_worker = HelpWorker({grp.name: grp})
+    runs = [
+        (worker, ["bench echo hello"]),
+        (worker, [f"bench io -s {args.io_seconds}"]),
+        (help_worker, ["help bench io"]),
+    ]
+    if args.concurrency:
+        # interactive commands next to long jobs, see `WORKER_LONG_CONCURRENCY`
+        slow = f"bench slow -s {args.slow_seconds}"
+        runs.append((worker, [slow] + ["bench echo mixed"] * 9))
+
+    results = OrderedDict()
+    for w, cmds in runs:
+        results.update(run_worker(w, w.callback, cmds, args.count, args.rate, slack))
+    return results
+
+
+def _format(results: OrderedDict) -> str:
+    width = max(len(name) for name in results)
+    header = ["msgs/s", "p50 ms", "p99 ms", "slack/cmd"]
+    lines = [f"{'command':<{width}} " + " ".join(f"{h:>10}" for h in header)]
+    for name, result in results.items():
+        values = " ".join(f"{v:>10.2f}" for v in result.values())
+        lines.append(f"{name:<{width}} {values}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=200, help="Messages per command.")
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Messages per second, 0 for no limit."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=0, help="WORKER_CONCURRENCY, 0 is inline."
+    )
+    parser.add_argument(
+        "--long-concurrency",
+        type=int,
+        default=0,
+        help="WORKER_LONG_CONCURRENCY, 0 runs long jobs with the rest.",
+    )
+    parser.add_argument(
+        "--io-seconds", type=float, default=0.05, help="Wait of `bench io`."
+    )
+    parser.add_argument(
+        "--slow-seconds", type=float, default=1.0, help="Wait of `bench slow`."
+    )
+    parser.add_argument(
+        "--slack-latency", type=float, default=0.0, help="Seconds per Slack call."
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2) if args.json else _format(results))
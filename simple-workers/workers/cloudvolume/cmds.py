@@ -1,11 +1,9 @@
 import os
-from subprocess import run
-from subprocess import STDOUT
-from subprocess import DEVNULL
 
 
 import click
 from google.cloud.storage import Client
+from CloudBotWorkersCommon.utils import long_job
 from CloudBotWorkersCommon.utils import admin_check
 
 
@@ -28,34 +26,68 @@ from CloudBotWorkersCommon.utils import admin_check
 def storage(ctx, *args, **kwargs):
     """Group for Storage commands."""
     ctx.obj["n_threads"] = kwargs["n_threads"]
-    ctx.obj["long_job"] = True
 
 
+def _transfer(ctx, op: str, src_path: str, dst_path: str):
+    """Transfer posting its progress to the command's thread."""
+    from .transfer import Progress
+    from .transfer import Transfer
+
+    progress = Progress(op, ctx.obj["slack_response"].send)
+    return Transfer(src_path, dst_path, ctx.obj["n_threads"], progress=progress)
+
+
+@long_job
 @storage.command(
     "copy",
-    help="Copy from source to destination. Paths must be protocols supported by CloudVolume.",
+    help="Copy files under SRC_PATH to DST_PATH. "
+    "Paths must be protocols supported by CloudVolume.",
     add_help_option=False,
 )
 @click.argument("src_path", type=str, required=True)
 @click.argument("dst_path", type=str, required=True)
 @click.pass_context
 def copy(ctx, *args, **kwargs):
-    # with Storage(kwargs["src_path"], n_threads=ctx.obj["n_threads"]) as src, Storage(
-    #     kwargs["dst_path"], n_threads=ctx.obj["n_threads"]
-    # ) as dst:
-    #     files = src.list_files(prefix="yo", flat=True)
-    #     contents = src.get_files(files)
-    #     dst.put_files(zip(files, contents))  # pylint: disable=no-member
-    # return f"Copied files from `{kwargs['src_path']}` to `{kwargs['dst_path']}`"
-    cmd = ["gsutil", "-m", "cp", "-R", kwargs["src_path"], kwargs["dst_path"]]
-    run(cmd, stdout=DEVNULL, stderr=STDOUT)
-    return f"Copied files from `{kwargs['src_path']}` to `{kwargs['dst_path']}`"
+    transfer = _transfer(ctx, "copy", kwargs["src_path"], kwargs["dst_path"])
+    transfer.copy()
+    return (
+        f"Copied {transfer.summary()} from "
+        f"`{kwargs['src_path']}` to `{kwargs['dst_path']}`"
+    )
+
+
+@long_job
+@storage.command(
+    "sync",
+    help="Copy files under SRC_PATH that are missing or changed in DST_PATH. "
+    "Files are compared by size and checksum (GCS) or modification time (local).",
+    add_help_option=False,
+)
+@click.option(
+    "--delete",
+    "-d",
+    is_flag=True,
+    help="Delete files in DST_PATH that are not in SRC_PATH.",
+)
+@click.argument("src_path", type=str, required=True)
+@click.argument("dst_path", type=str, required=True)
+@click.pass_context
+def sync(ctx, *args, **kwargs):
+    if kwargs["delete"]:
+        admin_check(ctx.obj["user_id"])
+    transfer = _transfer(ctx, "sync", kwargs["src_path"], kwargs["dst_path"])
+    transfer.sync(delete=kwargs["delete"])
+    return (
+        f"Synced {transfer.summary()} from "
+        f"`{kwargs['src_path']}` to `{kwargs['dst_path']}`"
+    )
 
 
+@long_job
 @storage.command(
     "move",
-    help="Move from source to destination. "
-    "Paths must be protocols supported by CloudVolume."
+    help="Move files under SRC_PATH to DST_PATH. "
+    "Paths must be protocols supported by CloudVolume. "
     "Warning: This will delete files in SRC_PATH.",
     add_help_option=False,
 )
@@ -64,32 +96,29 @@ def copy(ctx, *args, **kwargs):
 @click.pass_context
 def move(ctx, *args, **kwargs):
     admin_check(ctx.obj["user_id"])
-    # with Storage(kwargs["src_path"], n_threads=ctx.obj["n_threads"]) as src, Storage(
-    #     kwargs["dst_path"], n_threads=ctx.obj["n_threads"]
-    # ) as dst:
-    #     files = src.list_files()
-    #     dst.put_files(src.get_files(files))  # pylint: disable=no-member
-    #     src.delete_files(files)
-    # return f"Moved files from `{kwargs['src_path']}` to `{kwargs['dst_path']}`"
-    cmd = ["gsutil", "-m", "mv", kwargs["src_path"], kwargs["dst_path"]]
-    proc = run(cmd, capture_output=True)
-    if proc.returncode:
-        raise ValueError(proc.stderr.decode("utf-8"))
-    return f"Moved files from `{kwargs['src_path']}` to `{kwargs['dst_path']}`"
+    transfer = _transfer(ctx, "move", kwargs["src_path"], kwargs["dst_path"])
+    transfer.move()
+    return (
+        f"Moved {transfer.summary()} from "
+        f"`{kwargs['src_path']}` to `{kwargs['dst_path']}`"
+    )
 
 
+@long_job
 @storage.command(
     "rm",
-    help="Delete files in the bucket. "
-    "cv storage rm gs://<bucket>/<subdir>** will recursively delete files.",
+    help="Delete the file at SRC_PATH and every file under it. "
+    "cv storage rm gs://<bucket>/<prefix>** deletes every file starting with prefix.",
     add_help_option=False,
 )
 @click.argument("src_path", type=str, required=True)
 @click.pass_context
 def delete(ctx, *args, **kwargs):
+    from .transfer import Delete
+    from .transfer import Progress
+
     admin_check(ctx.obj["user_id"])
-    cmd = ["gsutil", "-m", "rm", kwargs["src_path"]]
-    proc = run(cmd, capture_output=True)
-    if proc.returncode:
-        raise ValueError(proc.stderr.decode("utf-8"))
-    return f"Deleted files matching `{kwargs['src_path']}`"
+    progress = Progress("rm", ctx.obj["slack_response"].send)
+    deleted = Delete(kwargs["src_path"], ctx.obj["n_threads"], progress=progress)
+    deleted.run()
+    return f"Deleted {deleted.summary()} matching `{kwargs['src_path']}`"
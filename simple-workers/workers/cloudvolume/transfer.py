@@ -0,0 +1,696 @@
+"""
+Copies and deletes files in storage paths supported by CloudFiles
+(gs://, s3://, file://, ...) in this process, with a pool of `n_threads`.
+Within GCS objects are rewritten server side and local files are copied on
+disk, other pairs are downloaded and uploaded through this process.
+"""
+import os
+from time import monotonic
+from itertools import chain
+from itertools import islice
+from functools import partial
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Iterator
+from threading import Lock
+from threading import local
+from threading import Condition
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+
+from CloudBotWorkersCommon import metrics
+
+
+# errors listed in the message of a failed transfer
+MAX_REPORTED_ERRORS = 10
+# objects per GCS batch request, the batch API takes at most 100 calls
+BATCH_SIZE = 100
+# listing of a prefix is split into ranges starting at these characters
+SHARD_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_FILES = metrics.counter("storage_transfer_files_total", "Files transferred.")
+_BYTES = metrics.counter("storage_transfer_bytes_total", "Bytes transferred.")
+_ERRORS = metrics.counter("storage_transfer_errors_total", "Files that failed.")
+_RATE = metrics.gauge(
+    "storage_transfer_bytes_per_second", "Throughput of running transfers."
+)
+
+
+def _protocol(p: str) -> str:
+    return p.split("://", 1)[0] if "://" in p else "file"
+
+
+def _local_path(p: str) -> str:
+    return p[len("file://") :] if p.startswith("file://") else p
+
+
+def _gcs_path(p: str) -> Tuple[str, str]:
+    """Bucket and prefix of `gs://bucket/prefix`."""
+    bucket, _, prefix = p[len("gs://") :].partition("/")
+    prefix = prefix.rstrip("/")
+    return bucket, f"{prefix}/" if prefix else ""
+
+
+def _size(nbytes: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+def _shards(prefix: str) -> List[Tuple[str, str]]:
+    """`start_offset` and `end_offset` of ranges covering every name under `prefix`."""
+    bounds = [None] + [prefix + c for c in SHARD_CHARS] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _raise_errors(errors: List[Tuple[str, str]], files: int) -> None:
+    if not errors:
+        return
+    lines = [f"{key}: {err}" for key, err in errors[:MAX_REPORTED_ERRORS]]
+    if len(errors) > MAX_REPORTED_ERRORS:
+        lines.append(f"... and {len(errors) - MAX_REPORTED_ERRORS} more")
+    raise TransferError(
+        f"{len(errors)} of {len(errors) + files} files failed:\n" + "\n".join(lines)
+    )
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class TransferError(ValueError):
+    pass
+
+
+class Progress:
+    """
+    Files and bytes done, rate and ETA of a transfer.
+    A progress line is passed to `notify` at most every `interval` seconds
+    (`CV_PROGRESS_INTERVAL`, default 30) and totals go to the
+    `storage_transfer_*` metrics, labeled with `op`.
+    """
+
+    def __init__(self, op: str, notify: callable = print, interval: float = None):
+        self.op = op
+        self.notify = notify
+        self.interval = float(
+            os.environ.get("CV_PROGRESS_INTERVAL", 30) if interval is None else interval
+        )
+        self.files = 0
+        self.nbytes = 0
+        self.errors = 0
+        self.total = None
+        self._listed = 0
+        self._started = monotonic()
+        self._posted = self._started
+        self._lock = Lock()
+
+    def listed(self, files: int = 1, done: bool = False) -> None:
+        """Counts listed files, the total is known once listing is `done`."""
+        with self._lock:
+            if done:
+                self.total = self._listed
+            else:
+                self._listed += files
+
+    def add(self, nbytes: int = 0, error: bool = False, files: int = 1) -> None:
+        """`files` done with `nbytes` between them, or failed with `error`."""
+        with self._lock:
+            if error:
+                self.errors += files
+                _ERRORS.inc(files, op=self.op)
+            else:
+                self.files += files
+                self.nbytes += nbytes
+                _FILES.inc(files, op=self.op)
+                _BYTES.inc(nbytes, op=self.op)
+            now = monotonic()
+            if now - self._posted < self.interval:
+                return
+            self._posted = now
+            line = self.line()
+            _RATE.set(self.nbytes / max(now - self._started, 1e-9), op=self.op)
+        self.notify(line)
+
+    def line(self) -> str:
+        elapsed = max(monotonic() - self._started, 1e-9)
+        done = self.files + self.errors
+        line = f"{self.op}: {self.files}"
+        if self.total:
+            line += f"/{self.total}"
+        line += f" files, {_size(self.nbytes)} at {_size(self.nbytes / elapsed)}/s"
+        if self.total and 0 < done < self.total:
+            eta = (self.total - done) * elapsed / done
+            line += f", ETA {_duration(eta)}"
+        if self.errors:
+            line += f", {self.errors} failed"
+        return line
+
+    def finish(self) -> None:
+        """Posts the final line, the transfer no longer counts towards the rate."""
+        _RATE.set(0, op=self.op)
+        self.notify(self.line())
+
+
+class Transfer:
+    """
+    Files under `src_path` are copied to the same relative paths under `dst_path`.
+    A `src_path` that is a single file is copied to `dst_path`, or into it when
+    `dst_path` ends with `/` or is a local directory.
+    Listing is consumed as it is paged in and at most `2 * n_threads` files are
+    in flight, so memory does not grow with the number of files.
+    Content is copied as stored, a compressed file keeps its `Content-Encoding`.
+    """
+
+    def __init__(
+        self,
+        src_path: str,
+        dst_path: str,
+        n_threads: int = 16,
+        progress: Progress = None,
+    ):
+        self.progress = progress
+        self.src_path = src_path.rstrip("/")
+        self.dst_path = dst_path.rstrip("/")
+        self._dst_dir = dst_path.endswith("/") or (
+            _protocol(dst_path) == "file" and os.path.isdir(_local_path(dst_path))
+        )
+        # destination names of files copied under another name
+        self._renames: Dict[str, str] = {}
+        self.n_threads = max(1, int(n_threads))
+        self.files = 0
+        self.nbytes = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.errors: List[Tuple[str, str]] = []
+        self._local = local()
+        self._lock = Lock()
+
+    def _cloudfiles(self, p: str):
+        """CloudFiles of the calling thread, they are not shared between threads."""
+        from cloudfiles import CloudFiles
+
+        cfs = self._local.__dict__.setdefault("cfs", {})
+        if p not in cfs:
+            cfs[p] = CloudFiles(p, progress=False, num_threads=1)
+        return cfs[p]
+
+    @property
+    def mode(self) -> str:
+        """`gcs` and `local` copy within the provider, `stream` through this process."""
+        src, dst = _protocol(self.src_path), _protocol(self.dst_path)
+        if src == dst == "gs":
+            return "gcs"
+        if src == dst == "file":
+            return "local"
+        return "stream"
+
+    def list(self) -> Iterator[str]:
+        if self.mode == "local":
+            # files as stored, compressed ones keep their suffix
+            root = _local_path(self.src_path)
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    yield os.path.relpath(os.path.join(dirpath, filename), root)
+            return
+        yield from self._cloudfiles(self.src_path).list(flat=False)
+
+    def _dst_key(self, key: str) -> str:
+        return self._renames.get(key, key)
+
+    def _sources(self) -> Iterator[str]:
+        """
+        Listing of `src_path`, or the name of the single file at `src_path`
+        with the paths moved to the parent directories.
+        """
+        keys = self.list()
+        first = next(keys, None)
+        if first is not None:
+            return chain([first], keys)
+
+        parent, _, name = self.src_path.rpartition("/")
+        if self.mode == "local":
+            single = os.path.isfile(_local_path(self.src_path))
+        else:
+            single = bool(parent) and self._cloudfiles(parent).exists(name)
+        if not single:
+            raise TransferError(f"No files match `{self.src_path}`.")
+        self.src_path = parent
+        if not self._dst_dir:
+            self.dst_path, _, dst_name = self.dst_path.rpartition("/")
+            self._renames[name] = dst_name
+        return iter([name])
+
+    def _gcs_blobs(self, key: str) -> tuple:
+        """Source and destination blobs of `key`, with a client per thread."""
+        from google.cloud.storage import Client
+
+        if not hasattr(self._local, "gcs"):
+            self._local.gcs = Client()
+        src_bucket, src_prefix = _gcs_path(self.src_path)
+        dst_bucket, dst_prefix = _gcs_path(self.dst_path)
+        return (
+            self._local.gcs.bucket(src_bucket).blob(src_prefix + key),
+            self._local.gcs.bucket(dst_bucket).blob(dst_prefix + self._dst_key(key)),
+        )
+
+    def _rewrite_file(self, key: str) -> int:
+        """
+        Server side copy, metadata and `Content-Encoding` are kept.
+        Large objects or different locations may take several rewrite calls.
+        """
+        src, dst = self._gcs_blobs(key)
+        token, _, total = dst.rewrite(src)
+        while token is not None:
+            token, _, total = dst.rewrite(src, token=token)
+        return total
+
+    def _copy_local_file(self, key: str) -> int:
+        from shutil import copy2
+
+        src = os.path.join(_local_path(self.src_path), key)
+        dst = os.path.join(_local_path(self.dst_path), self._dst_key(key))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        copy2(src, dst)
+        return os.path.getsize(dst)
+
+    def _copy_file(self, key: str) -> int:
+        if self.mode == "gcs":
+            return self._rewrite_file(key)
+        if self.mode == "local":
+            return self._copy_local_file(key)
+        return self._stream_file(key)
+
+    def _move_file(self, key: str) -> int:
+        """Copy, then delete the source once the copy succeeded."""
+        if self.mode == "local":
+            from shutil import move
+
+            src = os.path.join(_local_path(self.src_path), key)
+            dst = os.path.join(_local_path(self.dst_path), self._dst_key(key))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            nbytes = os.path.getsize(src)
+            move(src, dst)
+            return nbytes
+        nbytes = self._copy_file(key)
+        if self.mode == "gcs":
+            self._gcs_blobs(key)[0].delete()
+        else:
+            self._cloudfiles(self.src_path).delete(key)
+        return nbytes
+
+    def _delete_dst_file(self, key: str) -> None:
+        if self.mode == "gcs":
+            self._gcs_blobs(key)[1].delete()
+        elif self.mode == "local":
+            os.remove(os.path.join(_local_path(self.dst_path), key))
+        else:
+            self._cloudfiles(self.dst_path).delete(key)
+
+    def _manifest(self, p: str) -> Dict[str, tuple]:
+        """
+        Relative path to what identifies the content of each file under `p`,
+        from the listing where the provider has it:
+        size and crc32c on GCS, size and modification time of local files
+        (`copy2` keeps it). Across providers size and MD5 of the stored bytes,
+        `None` where the provider does not give it (e.g. S3 multipart uploads).
+        """
+        if self.mode == "gcs":
+            from google.cloud.storage import Client
+
+            bucket, prefix = _gcs_path(p)
+            return {
+                blob.name[len(prefix) :]: (blob.size, blob.crc32c)
+                for blob in Client().list_blobs(bucket, prefix=prefix)
+            }
+        if self.mode == "local":
+            root = _local_path(p)
+            manifest = {}
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    key = os.path.relpath(os.path.join(dirpath, filename), root)
+                    manifest[key] = (stat.st_size, stat.st_mtime_ns)
+            return manifest
+
+        cf = self._cloudfiles(p)
+        keys = iter(cf.list(flat=False))
+        manifest = {}
+        with ThreadPoolExecutor(self.n_threads, thread_name_prefix="manifest") as ex:
+            while True:
+                batch = list(islice(keys, 1000))
+                if not batch:
+                    return manifest
+                heads = cf.head(batch)
+                hashes = ex.map(partial(self._md5, p), heads, heads.values())
+                for (key, head), md5 in zip(heads.items(), hashes):
+                    manifest[key] = (head and head.get("Content-Length"), md5)
+
+    def _md5(self, p: str, key: str, head: dict) -> str:
+        """Hex MD5 of the file as stored, local files are read to compute it."""
+        protocol = _protocol(p)
+        if head is None:
+            return None
+        if protocol == "file":
+            from hashlib import md5
+
+            content = self._cloudfiles(p).get([key], raw=True)[0]["content"]
+            return None if content is None else md5(content).hexdigest()
+        if protocol == "gs" and head.get("Content-Md5"):
+            from base64 import b64decode
+
+            return b64decode(head["Content-Md5"]).hex()
+        # S3 etags are the MD5 except for multipart uploads
+        etag = (head.get("ETag") or "").strip('"')
+        if protocol == "s3" and etag and "-" not in etag:
+            return etag
+        return None
+
+    def _stream_file(self, key: str) -> int:
+        result = self._cloudfiles(self.src_path).get([key], raw=True)[0]
+        if result["error"] is not None:
+            raise result["error"]
+        if result["content"] is None:
+            raise FileNotFoundError(f"{self.src_path}/{key}")
+        self._cloudfiles(self.dst_path).put(
+            self._dst_key(key), result["content"], raw=True, compress=result["compress"]
+        )
+        return len(result["content"])
+
+    def _run(self, fn: callable, keys: Iterator[str]) -> None:
+        slots = BoundedSemaphore(2 * self.n_threads)
+
+        def done(key, future):
+            slots.release()
+            error = future.exception()
+            nbytes = None if error else future.result()
+            with self._lock:
+                if error:
+                    self.errors.append((key, repr(error)))
+                elif nbytes is None:
+                    self.deleted += 1
+                else:
+                    self.nbytes += nbytes
+                    self.files += 1
+            if progress is not None:
+                progress.add(nbytes or 0, error=error is not None)
+
+        progress = self.progress
+        with ThreadPoolExecutor(self.n_threads, thread_name_prefix="transfer") as ex:
+            for key in keys:
+                if progress is not None:
+                    progress.listed()
+                slots.acquire()
+                future = ex.submit(fn, key)
+                future.add_done_callback(lambda f, key=key: done(key, f))
+            if progress is not None:
+                progress.listed(done=True)
+
+    def _finish(self) -> None:
+        if self.progress is not None:
+            self.progress.finish()
+
+    def copy(self) -> "Transfer":
+        self._run(self._copy_file, self._sources())
+        self._finish()
+        self.raise_errors()
+        return self
+
+    def move(self) -> "Transfer":
+        """Files that failed to copy are left in place."""
+        self._run(self._move_file, self._sources())
+        self._finish()
+        self.raise_errors()
+        return self
+
+    def sync(self, delete: bool = False) -> "Transfer":
+        """
+        Copies files missing from `dst_path` or different from the source,
+        compared by the manifests of both sides. Files whose manifest misses
+        a value (no hash from the provider) are always copied.
+        With `delete` files only in `dst_path` are deleted.
+        """
+        src = self._manifest(self.src_path)
+        if not src:
+            raise TransferError(f"No files under `{self.src_path}`.")
+        dst = self._manifest(self.dst_path)
+        changed = [
+            key for key, meta in src.items() if dst.get(key) != meta or None in meta
+        ]
+        self.skipped = len(src) - len(changed)
+        self._run(self._copy_file, iter(changed))
+        if delete:
+            extra = [key for key in dst if key not in src]
+            self._run(self._delete_dst_file, iter(extra))
+        self._finish()
+        self.raise_errors()
+        return self
+
+    def raise_errors(self) -> None:
+        _raise_errors(self.errors, self.files)
+
+    def summary(self) -> str:
+        summary = f"{self.files} files, {_size(self.nbytes)}"
+        if self.skipped:
+            summary += f", {self.skipped} unchanged files skipped"
+        if self.deleted:
+            summary += f", {self.deleted} files deleted"
+        return summary
+
+
+class Delete:
+    """
+    Deletes the file at `path` and every file under `path/`. With a trailing `**`
+    every file whose name starts with the rest of `path` is deleted, like `gsutil rm`.
+    On GCS the prefix is listed in shards by a pool of `n_threads`, one level of
+    directories deep, and objects are deleted in batch requests of `BATCH_SIZE`
+    by another pool; a failed batch is retried one object at a time.
+    Other protocols list serially and delete chunks of keys with CloudFiles.
+    At most `2 * n_threads` chunks are listed ahead of the deletes.
+    """
+
+    def __init__(self, path: str, n_threads: int = 16, progress: Progress = None):
+        if path.endswith("**"):
+            self.path, self.wildcard = path[:-2], True
+        elif "*" in path:
+            raise ValueError("Only a trailing `**` wildcard is supported.")
+        else:
+            self.path, self.wildcard = path.rstrip("/"), False
+        if not self.wildcard and "/" not in self.path.partition("://")[2]:
+            raise ValueError(f"Use `{self.path}/**` to delete a whole bucket.")
+        self.n_threads = max(1, int(n_threads))
+        self.progress = progress
+        self.files = 0
+        self.nbytes = 0
+        self.errors: List[Tuple[str, str]] = []
+        self._local = local()
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._pending = 0
+        self._slots = BoundedSemaphore(2 * self.n_threads)
+
+    def _client(self):
+        """GCS client of the calling thread, a batch is bound to its client."""
+        from google.cloud.storage import Client
+
+        if not hasattr(self._local, "gcs"):
+            self._local.gcs = Client()
+        return self._local.gcs
+
+    def _submit(self, ex: ThreadPoolExecutor, fn: callable, key: str, *args) -> None:
+        """Runs `fn` in `ex`, an exception is reported as a failure of `key`."""
+
+        def done(future):
+            error = future.exception()
+            with self._lock:
+                if error:
+                    self.errors.append((key, repr(error)))
+                self._pending -= 1
+                self._idle.notify_all()
+
+        with self._lock:
+            self._pending += 1
+        ex.submit(fn, *args).add_done_callback(done)
+
+    def _queue(self, fn: callable, chunk: list) -> None:
+        """Deletes `chunk` with `fn`, blocks while too many chunks are queued."""
+        if self.progress is not None:
+            self.progress.listed(len(chunk))
+        self._slots.acquire()
+
+        def delete():
+            try:
+                fn(chunk)
+            finally:
+                self._slots.release()
+
+        self._submit(self._deleter, delete, chunk[0][0])
+
+    def _done(self, deleted: List[Tuple[str, int]], errors: List[Tuple[str, str]]):
+        nbytes = sum(size for _, size in deleted)
+        with self._lock:
+            self.files += len(deleted)
+            self.nbytes += nbytes
+            self.errors.extend(errors)
+        if self.progress is not None:
+            self.progress.add(nbytes, files=len(deleted))
+            if errors:
+                self.progress.add(error=True, files=len(errors))
+
+    def _delete_blobs(self, bucket: str, chunk: List[Tuple[str, int]]) -> None:
+        """One batch request, objects of a failed batch are deleted one by one."""
+        from google.api_core.exceptions import NotFound
+
+        client = self._client()
+        bucket = client.bucket(bucket)
+        try:
+            with client.batch():
+                for name, _ in chunk:
+                    bucket.blob(name).delete(client=client)
+            self._done(chunk, [])
+            return
+        except Exception:
+            pass
+
+        deleted, errors = [], []
+        for name, size in chunk:
+            try:
+                bucket.blob(name).delete(client=client)
+            except NotFound:
+                # deleted by the failed batch
+                pass
+            except Exception as err:
+                errors.append((name, repr(err)))
+                continue
+            deleted.append((name, size))
+        self._done(deleted, errors)
+
+    def _list_shard(self, bucket: str, prefix: str, start: str, end: str, top: bool):
+        """
+        Queues the objects of one shard. The `top` shards stop at the first `/`
+        and split each directory they find into shards of its own.
+        """
+        blobs = self._client().list_blobs(
+            bucket,
+            prefix=prefix,
+            start_offset=start,
+            end_offset=end,
+            delimiter="/" if top else None,
+            fields="items(name,size),prefixes,nextPageToken",
+        )
+        delete = partial(self._delete_blobs, bucket)
+        chunk = []
+        for blob in blobs:
+            chunk.append((blob.name, blob.size or 0))
+            if len(chunk) == BATCH_SIZE:
+                self._queue(delete, chunk)
+                chunk = []
+        if chunk:
+            self._queue(delete, chunk)
+        if top:
+            for sub in sorted(blobs.prefixes):
+                for sub_start, sub_end in _shards(sub):
+                    self._submit(
+                        self._lister,
+                        self._list_shard,
+                        sub,
+                        bucket,
+                        sub,
+                        sub_start,
+                        sub_end,
+                        False,
+                    )
+
+    def _cloudfiles(self, p: str):
+        """CloudFiles of the calling thread, they are not shared between threads."""
+        from cloudfiles import CloudFiles
+
+        cfs = self._local.__dict__.setdefault("cfs", {})
+        if p not in cfs:
+            cfs[p] = CloudFiles(p, progress=False)
+        return cfs[p]
+
+    def _delete_keys(self, root: str, chunk: List[Tuple[str, int]]) -> None:
+        cf = self._cloudfiles(root)
+        keys = [key for key, _ in chunk]
+        try:
+            cf.delete(keys)
+            self._done(chunk, [])
+            return
+        except Exception:
+            pass
+
+        deleted, errors = [], []
+        for key, size in chunk:
+            try:
+                cf.delete(key)
+            except Exception as err:
+                errors.append((key, repr(err)))
+                continue
+            deleted.append((key, size))
+        self._done(deleted, errors)
+
+    def _run_gcs(self) -> None:
+        bucket, _, name = self.path[len("gs://") :].partition("/")
+        prefix = name
+        if not self.wildcard:
+            blob = self._client().bucket(bucket).get_blob(name)
+            if blob is not None:
+                chunk = [(name, blob.size or 0)]
+                self._queue(partial(self._delete_blobs, bucket), chunk)
+            prefix = f"{name}/"
+        for start, end in _shards(prefix):
+            self._submit(
+                self._lister,
+                self._list_shard,
+                prefix or bucket,
+                bucket,
+                prefix,
+                start,
+                end,
+                True,
+            )
+
+    def _run_cloudfiles(self) -> None:
+        root, _, name = self.path.rpartition("/")
+        cf = self._cloudfiles(root)
+        delete = partial(self._delete_keys, root)
+        keys = iter(cf.list(prefix=name if self.wildcard else f"{name}/", flat=False))
+        if not self.wildcard:
+            if _protocol(root) == "file":
+                # a directory exists for CloudFiles
+                single = os.path.isfile(os.path.join(_local_path(root), name))
+            else:
+                single = cf.exists(name)
+            if single:
+                keys = chain([name], keys)
+        while True:
+            chunk = [(key, 0) for key in islice(keys, BATCH_SIZE)]
+            if not chunk:
+                return
+            self._queue(delete, chunk)
+
+    def run(self) -> "Delete":
+        self._lister = ThreadPoolExecutor(self.n_threads, thread_name_prefix="rm-list")
+        self._deleter = ThreadPoolExecutor(self.n_threads, thread_name_prefix="rm")
+        with self._lister, self._deleter:
+            if _protocol(self.path) == "gs":
+                self._run_gcs()
+            else:
+                self._run_cloudfiles()
+            with self._lock:
+                while self._pending:
+                    self._idle.wait()
+        if self.progress is not None:
+            self.progress.listed(done=True)
+            self.progress.finish()
+        _raise_errors(self.errors, self.files)
+        return self
+
+    def summary(self) -> str:
+        return f"{self.files} files, {_size(self.nbytes)}"
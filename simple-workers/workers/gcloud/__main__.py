@@ -1,7 +1,12 @@
+from CloudBotWorkersCommon import config
+from CloudBotWorkersCommon.aio import AsyncWorker
 from CloudBotWorkersCommon.types import Worker
 
 from . import cmd_grp
 from . import ROUTING_KEY
 
-worker = Worker(cmd_grp)
+if config.WORKER_RUNTIME == "asyncio":
+    worker = AsyncWorker(cmd_grp)
+else:
+    worker = Worker(cmd_grp)
 worker.start(ROUTING_KEY, worker.callback)
@@ -24,11 +24,13 @@ def generate_signed_url(
     bucket_name,
     object_name,
     subresource=None,
-    expiration=int(os.environ["KEY_LINK_EXPIRATION"]),
+    expiration=None,
     http_method="GET",
     query_parameters=None,
     headers=None,
 ):
+    if expiration is None:
+        expiration = int(os.environ["KEY_LINK_EXPIRATION"])
     escaped_object_name = quote(six.ensure_binary(object_name), safe=b"/~")
     canonical_uri = "/{}".format(escaped_object_name)
 
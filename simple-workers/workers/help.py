@@ -31,7 +31,14 @@ def load_cmds() -> OrderedDict:
 
 
 if __name__ == "__main__":
-    from CloudBotWorkersCommon.types import HelpWorker
-
-    worker = HelpWorker(load_cmds())
-    worker.start(ROUTING_KEY, worker.callback)
+    from os import path
+    from CloudBotWorkersCommon import manifest
+
+    manifest.main(
+        ROUTING_KEY,
+        load_cmds,
+        path.join(path.dirname(__file__), "help_manifest.json"),
+        [path.dirname(path.abspath(__file__))],
+        env=["DEFAULT_GCP_PROJECT", "CV_STORAGE_THREADS", "KEY_LINK_EXPIRATION"],
+        groups={"gcloud": "GCLOUD_WORKER", "cv": "CV_WORKER"},
+    )
@@ -0,0 +1,206 @@
+"""
+Micro-benchmarks for the ground truth data path.
+
+Runs on synthetic stacks written to a temporary directory (file:// paths),
+nothing goes over the network. From `specialized-workers/groudtruth`:
+
+    python -m benchmarks.data_path --shape 1024 1024 64 --repeat 3
+"""
+import os
+import json
+import argparse
+import tempfile
+import tracemalloc
+from io import BytesIO
+from time import perf_counter
+from typing import Tuple
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+MB = 1024 * 1024
+
+
+def _synthetic_seg(shape: Tuple[int, int, int], n_segments: int = 1000) -> np.ndarray:
+    """Blocky segmentation, labels change every 32 voxels in x and y."""
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(
+        1, n_segments, size=(shape[0] // 32 + 1, shape[1] // 32 + 1, shape[2])
+    )
+    seg = np.repeat(np.repeat(blocks, 32, axis=0), 32, axis=1)
+    return seg[: shape[0], : shape[1], :].astype(np.uint32)
+
+
+def _measure(fn, nbytes: int, slices: int, repeat: int) -> dict:
+    """Best wall time of `repeat` runs, peak memory from one more traced run."""
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        seconds = min(seconds, perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return OrderedDict(
+        seconds=seconds,
+        mb_per_s=nbytes / MB / seconds,
+        slices_per_s=slices / seconds,
+        peak_mb=peak / MB,
+    )
+
+
+def _bench_load_image(seg: np.ndarray, repeat: int) -> dict:
+    from src.data_io import _load_image
+
+    img_bytes = BytesIO()
+    Image.fromarray(seg[:, :, 0].T).save(img_bytes, format="tiff")
+    img_bytes = img_bytes.getvalue()
+    return _measure(
+        lambda: _load_image(img_bytes), seg[:, :, 0].nbytes, 1, repeat=repeat
+    )
+
+
+def _bench_write_to_cloud_bucket(seg: np.ndarray, path: str, repeat: int) -> dict:
+    from src.data_io import write_to_cloud_bucket
+
+    return _measure(
+        lambda: write_to_cloud_bucket(path, seg), seg.nbytes, seg.shape[2], repeat
+    )
+
+
+def _bench_load_images(seg: np.ndarray, path: str, repeat: int) -> dict:
+    from src.data_io import load_images
+    from src.data_io import write_to_cloud_bucket
+
+    write_to_cloud_bucket(path, seg)
+    return _measure(lambda: load_images(path), seg.nbytes, seg.shape[2], repeat)
+
+
+def _bench_load_from_omni_h5(seg: np.ndarray, tmp_dir: str, repeat: int) -> dict:
+    from h5py import File
+    from src.data_io import load_from_omni_h5
+
+    h5_path = os.path.join(tmp_dir, "omni", "segmentation.h5")
+    os.makedirs(os.path.dirname(h5_path))
+    with File(h5_path, "w") as f:
+        f.create_dataset("main", data=seg.transpose(2, 1, 0))
+
+    # every segment gets one of the omni types: working, valid, uncertain
+    with open(os.path.join(tmp_dir, "omni", "segments.txt"), "w") as f:
+        f.write("segments\nid,type\n")
+        for seg_id in np.unique(seg):
+            f.write(f"{seg_id},{seg_id % 3 + 1}\n")
+    return _measure(
+        lambda: load_from_omni_h5(h5_path), seg.nbytes, seg.shape[2], repeat
+    )
+
+
+def _bench_draw_bounding_cube(seg: np.ndarray, repeat: int) -> dict:
+    from cloudvolume.lib import Bbox
+    from src.utils import draw_bounding_cube
+
+    pad = np.array(seg.shape) // 4
+    bbox = Bbox(pad, np.array(seg.shape) - pad - 1)
+    arr = seg.copy()
+    return _measure(
+        lambda: draw_bounding_cube(arr, bbox), seg.nbytes, seg.shape[2], repeat
+    )
+
+
+def _bench_cutout_draw_bounding_cube(seg: np.ndarray, tmp_dir: str, repeat: int):
+    from cloudvolume import CloudVolume
+    from src.cutout import _draw_bounding_cube
+
+    cv_path = f"file://{tmp_dir}/image"
+    info = CloudVolume.create_new_info(
+        num_channels=1,
+        layer_type="image",
+        data_type="uint8",
+        encoding="raw",
+        resolution=[8, 8, 40],
+        voxel_offset=[0, 0, 0],
+        volume_size=seg.shape,
+        chunk_size=(64, 64, 8),
+    )
+    cv = CloudVolume(cv_path, info=info, mip=0)
+    cv.commit_info()
+    cv[:, :, :] = (seg % 255).astype(np.uint8)
+
+    pad = [s // 8 for s in seg.shape]
+    bbox = pad + [s - p for s, p in zip(seg.shape, pad)]
+    nbytes = int(np.prod(seg.shape))
+    return _measure(
+        lambda: _draw_bounding_cube(cv_path, bbox, 0, pad),
+        nbytes,
+        seg.shape[2],
+        repeat,
+    )
+
+
+def run(shape: Tuple[int, int, int], repeat: int) -> OrderedDict:
+    seg = _synthetic_seg(shape)
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benches = OrderedDict(
+            [
+                ("data_io._load_image", lambda: _bench_load_image(seg, repeat)),
+                (
+                    "data_io.write_to_cloud_bucket",
+                    lambda: _bench_write_to_cloud_bucket(
+                        seg, f"file://{tmp_dir}/write", repeat
+                    ),
+                ),
+                (
+                    "data_io.load_images",
+                    lambda: _bench_load_images(seg, f"file://{tmp_dir}/load", repeat),
+                ),
+                (
+                    "data_io.load_from_omni_h5",
+                    lambda: _bench_load_from_omni_h5(seg, tmp_dir, repeat),
+                ),
+                (
+                    "utils.draw_bounding_cube",
+                    lambda: _bench_draw_bounding_cube(seg, repeat),
+                ),
+                (
+                    "cutout._draw_bounding_cube",
+                    lambda: _bench_cutout_draw_bounding_cube(seg, tmp_dir, repeat),
+                ),
+            ]
+        )
+        for name, bench in benches.items():
+            try:
+                results[name] = bench()
+            except Exception as err:
+                results[name] = OrderedDict(error=repr(err))
+    return results
+
+
+def _format(results: OrderedDict) -> str:
+    width = max(len(name) for name in results)
+    header = ["seconds", "MB/s", "slices/s", "peak MB"]
+    lines = [f"{'function':<{width}} " + " ".join(f"{h:>10}" for h in header)]
+    for name, result in results.items():
+        if "error" in result:
+            lines.append(f"{name:<{width}} {result['error']}")
+            continue
+        values = " ".join(f"{v:>10.2f}" for v in result.values())
+        lines.append(f"{name:<{width}} {values}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--shape", type=int, nargs=3, default=[512, 512, 32], help="Stack size x y z."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs each.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = run(tuple(args.shape), args.repeat)
+    print(json.dumps(results, indent=2) if args.json else _format(results))
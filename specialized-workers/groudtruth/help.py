@@ -0,0 +1,29 @@
+"""
+Display help for avaiable commands.
+Outside of `src`, so serving help does not import the commands.
+"""
+from collections import OrderedDict
+
+from CloudBotWorkersCommon import config
+from CloudBotWorkersCommon import amqp_connection
+
+
+ROUTING_KEY = "help-gt-workers.#"
+
+
+def load_cmds() -> OrderedDict:
+    from src import cmd_grp
+
+    return OrderedDict([("gt", cmd_grp)])
+
+
+if __name__ == "__main__":
+    from os import path
+    from CloudBotWorkersCommon import manifest
+
+    manifest.main(
+        ROUTING_KEY,
+        load_cmds,
+        path.join(path.dirname(__file__), "help_manifest.json"),
+        [path.join(path.dirname(path.abspath(__file__)), "src")],
+    )
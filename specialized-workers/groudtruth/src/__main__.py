@@ -1,7 +1,14 @@
+from threading import Thread
+
+from CloudBotWorkersCommon import config
+from CloudBotWorkersCommon.slack import users
 from CloudBotWorkersCommon.types import Worker
 
 from . import cmd_grp
 from . import ROUTING_KEY
 
+if config.SLACK_USERS_WARMUP:
+    Thread(target=users.warm, name="slack-users", daemon=True).start()
+
 worker = Worker(cmd_grp)
 worker.start(ROUTING_KEY, worker.callback)
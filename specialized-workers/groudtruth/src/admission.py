@@ -0,0 +1,139 @@
+"""
+Jobs reserve their estimated memory before loading data, so jobs that would
+not fit next to the running ones wait for them instead of the container
+getting OOM-killed.
+"""
+from os import environ
+from typing import Tuple
+from threading import Condition
+from contextlib import contextmanager
+
+
+GB = 1024 ** 3
+
+# `load_images` holds the decoded slices and the stacked array,
+# the crop and CloudVolume upload buffers add about one more copy
+PREVIEW_OVERHEAD = 3
+# CloudVolume download buffer and the cutout array
+CUTOUT_OVERHEAD = 2
+
+
+def _memory_limit() -> int:
+    """cgroup memory limit of the container, physical memory if there is none."""
+    from os import sysconf
+
+    limit = sysconf("SC_PAGE_SIZE") * sysconf("SC_PHYS_PAGES")
+    for p in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(p) as f:
+                return min(limit, int(f.read().strip()))
+        except (OSError, ValueError):
+            continue
+    return limit
+
+
+def _default_budget() -> int:
+    """
+    `GT_MEMORY_BUDGET_GB`, if not set 80% of the memory limit split between
+    the processes of a `WORKER_POOL=process` pool, each has its own budget.
+    """
+    if "GT_MEMORY_BUDGET_GB" in environ:
+        return int(float(environ["GT_MEMORY_BUDGET_GB"]) * GB)
+    processes = 1
+    if environ.get("WORKER_POOL") == "process":
+        processes = max(1, int(environ.get("WORKER_CONCURRENCY", 0)))
+    return int(_memory_limit() * 0.8) // processes
+
+
+class MemoryBudget:
+    """
+    Bytes reserved by running jobs of this process.
+    A job that does not fit waits up to `timeout` seconds for others to finish,
+    a job larger than the whole budget is rejected.
+    Processes do not share a budget, with several worker processes
+    (supervisord `numprocs` > 1) each needs its share of the memory limit.
+    """
+
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        self.used = 0
+        self._cond = Condition()
+
+    def fits(self, nbytes: int) -> bool:
+        return nbytes <= self.limit
+
+    @contextmanager
+    def reserve(self, nbytes: int, notify: callable = print):
+        if not self.fits(nbytes):
+            raise ValueError(
+                f"Job needs about {nbytes / GB:.1f} GB, "
+                f"more than the memory budget of {self.limit / GB:.1f} GB."
+            )
+        with self._cond:
+            used = self.used
+        if used + nbytes > self.limit:
+            # outside the lock, posting to slack may wait for its rate limits
+            notify(
+                f"Waiting for memory: job needs {nbytes / GB:.1f} GB, "
+                f"{used / GB:.1f} of {self.limit / GB:.1f} GB in use."
+            )
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self.used + nbytes <= self.limit, self.timeout
+            ):
+                raise ValueError(
+                    f"Timed out after {self.timeout:.0f}s waiting for memory."
+                )
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+
+budget = MemoryBudget(
+    _default_budget(), float(environ.get("GT_ADMISSION_TIMEOUT", 3600))
+)
+
+
+def preview_bytes(meta) -> int:
+    """The TIFF stack covers `meta.src_bbox`, decoded to uint32."""
+    from numpy import prod
+
+    return int(prod(meta.src_bbox.size3())) * 4 * PREVIEW_OVERHEAD
+
+
+def cutout_bytes(cv, bbox, src_mip: int, mip: int, pad: Tuple[int, int, int]):
+    """Padded `bbox` given at `src_mip`, downloaded from `cv` at `mip`."""
+    from numpy import prod
+    from numpy import dtype
+    from cloudvolume.lib import Vec
+    from cloudvolume.lib import Bbox
+
+    bbox = Bbox.from_list(bbox)
+    padded = Bbox(bbox.minpt - Vec(*pad), bbox.maxpt + Vec(*pad))
+    size = cv.bbox_to_mip(padded, src_mip, mip).size3()
+    itemsize = dtype(cv.meta.dtype).itemsize * cv.meta.num_channels
+    return int(prod(size)) * itemsize * CUTOUT_OVERHEAD
+
+
+def cutout_mip(cv_path: str, bbox, mip: int, pad: Tuple[int, int, int]):
+    """
+    Lowest mip from `mip` on at which the cutout fits in the budget,
+    downgrades large cutouts instead of rejecting them.
+    Returns the mip and its estimated bytes.
+    """
+    from cloudvolume import CloudVolume
+
+    cv = CloudVolume(cv_path, mip=mip, fill_missing=True)
+    for dst_mip in range(mip, len(cv.meta.scales)):
+        nbytes = cutout_bytes(cv, bbox, mip, dst_mip, pad)
+        if budget.fits(nbytes):
+            return dst_mip, nbytes
+    return mip, cutout_bytes(cv, bbox, mip, mip, pad)
@@ -1,4 +1,5 @@
 import click
+from CloudBotWorkersCommon.utils import long_job
 
 
 @click.group("volume", help="Perform actions on a given volume.", add_help_option=False)
@@ -7,6 +8,7 @@ def volume(ctx, *args, **kwargs):
     """Group for volume commands."""
 
 
+@long_job
 @volume.command(
     "preview",
     help="Preview volume in Neuroglancer. Takes a GCS path (gs://...) as input.",
@@ -28,10 +30,18 @@ def volume(ctx, *args, **kwargs):
     is_flag=True,
     help="Optionally transpose image data with (1, 0, 2)",
 )
+@click.option(
+    "--force",
+    "-f",
+    is_flag=True,
+    help="Run again even if the same job finished before.",
+)
 @click.argument("path", type=str, required=True)
 @click.pass_context
 def preview(ctx, *args, **kwargs):
     from .preview import upload
+    from .dedup import run_once
+    from .dedup import preview_key
     from .utils import get_username
 
     slack_response = ctx.obj["slack_response"]
@@ -40,30 +50,67 @@ def preview(ctx, *args, **kwargs):
 
     author = get_username(slack_response.event["user"])
     voxel_size = kwargs["voxel_size"]
-    upload(kwargs["path"], author, voxel_size, slack_response, kwargs["transpose"])
+    path, transpose = kwargs["path"], kwargs["transpose"]
+    event = slack_response.event
+    nglink, fresh = run_once(
+        preview_key(path, transpose, voxel_size),
+        lambda: upload(path, author, voxel_size, slack_response, transpose),
+        slack_response.send,
+        force=kwargs["force"],
+        owner=f"{event.get('channel')}:{event.get('event_ts')}",
+    )
+    if nglink is None:
+        return
+    if not fresh:
+        slack_response.send(nglink, broadcast=True)
     slack_response.send("Job completed.")
 
 
+@long_job
 @volume.command(
     "create_cutouts",
     help="Create a cutout of given volume(s). Takes a neuroglancer link as input.",
     add_help_option=False,
 )
 @click.argument("url", type=str, required=True)
+@click.option(
+    "--force",
+    "-f",
+    is_flag=True,
+    help="Run again even if the same job finished before.",
+)
 @click.pass_context
 def create_cutouts(ctx, *args, **kwargs):
     # https://neuromancer-seung-import.appspot.com/?json_url=https://poyntr.co/json/TVNqdURxQ05iNTZE
     from .cutout import create_cutouts
+    from .dedup import run_once
+    from .dedup import cutout_key
+    from .utils import get_ng_state
 
     slack_response = ctx.obj["slack_response"]
     slack_response.long_job = True
     slack_response.send("Working on it, check the thread for updates.")
 
     cutout_parameters = {"mip": 1, "pad": [256, 256, 4]}
-    create_cutouts(kwargs["url"], cutout_parameters, slack_response)
+    slack_response.send("Parsing state from neuroglancer link.")
+    state = get_ng_state(kwargs["url"])
+    event = slack_response.event
+    msgs, fresh = run_once(
+        cutout_key(state, cutout_parameters),
+        lambda: create_cutouts(kwargs["url"], cutout_parameters, slack_response, state),
+        slack_response.send,
+        force=kwargs["force"],
+        owner=f"{event.get('channel')}:{event.get('event_ts')}",
+    )
+    if msgs is None:
+        return
+    if not fresh:
+        for msg in msgs:
+            slack_response.send(f"```{msg}```", broadcast=True)
     slack_response.send("Job completed.")
 
 
+@long_job
 @volume.command(
     "create_bboxes",
     help="Create a bbox of given volume(s). Takes a neuroglancer link as input.",
@@ -42,21 +42,25 @@ def get_bboxes(layers: list) -> list:
     return bboxes
 
 
-def create_cutouts(url: str, parameters: dict, slack_response: SlackResponse) -> None:
+def create_cutouts(
+    url: str, parameters: dict, slack_response: SlackResponse, state: dict = None
+) -> list:
+    """Returns the message of each cutout, `state` is read from `url` if not given."""
     from .utils import get_ng_state
     from .utils import get_username
 
-    slack_response.send("Parsing state from neuroglancer link.")
-    state = get_ng_state(url)
     if state is None:
-        return "Nothing to do."
+        slack_response.send("Parsing state from neuroglancer link.")
+        state = get_ng_state(url)
+    if state is None:
+        return []
 
     slack_response.send("Parsing layers and bounding boxes.")
     cv_path = get_first_image_layer(state["layers"])
     bboxes = get_bboxes(state["layers"])
     if not bboxes:
         slack_response.send("Did not find bouding box. Nothing to do.")
-        return
+        return []
 
     try:
         voxel_size = state["navigation"]["pose"]["position"]["voxelSize"]
@@ -66,6 +70,7 @@ def create_cutouts(url: str, parameters: dict, slack_response: SlackResponse) ->
 
     slack_response.send("Parsed parameters, creating cutouts.")
     author = get_username(slack_response.event["user"])
+    msgs = []
     for b in bboxes:
         msg = cloudvolume_to_dir(
             cv_path,
@@ -73,11 +78,17 @@ def create_cutouts(url: str, parameters: dict, slack_response: SlackResponse) ->
             b["bbox"],
             parameters,
             author,
+            notify=slack_response.send,
         )
         slack_response.send(f"```{msg}```", broadcast=True)
+        msgs.append(msg)
+    return msgs
 
 
-def _draw_bounding_cube(cv_path: str, bbox, mip: int, pad: Tuple[int, int, int]):
+def _draw_bounding_cube(
+    cv_path: str, bbox, mip: int, pad: Tuple[int, int, int], src_mip: int = None
+):
+    """`bbox` and `pad` are given at `src_mip`, the cutout is made at `mip`."""
     from cloudvolume import CloudVolume
     from cloudvolume.lib import Vec
     from cloudvolume.lib import Bbox
@@ -85,14 +96,15 @@ def _draw_bounding_cube(cv_path: str, bbox, mip: int, pad: Tuple[int, int, int])
 
     cv = CloudVolume(cv_path, mip=mip, fill_missing=True)
     pad = Vec(*pad)
+    src_mip = mip if src_mip is None else src_mip
 
     mip0_bbox = Bbox.from_list(bbox)
     vol_start = mip0_bbox.minpt
     vol_stop = mip0_bbox.maxpt
     vol_bbox = cv.bbox_to_mip(  # pylint: disable=no-member
-        Bbox(vol_start - pad, vol_stop + pad), mip, mip
+        Bbox(vol_start - pad, vol_stop + pad), src_mip, mip
     )
-    draw_bbox = cv.bbox_to_mip(mip0_bbox, mip, mip)  # pylint: disable=no-member
+    draw_bbox = cv.bbox_to_mip(mip0_bbox, src_mip, mip)  # pylint: disable=no-member
     arr = cv[vol_bbox.to_slices()][:, :, :, 0]  # pylint: disable=unsubscriptable-object
     local_draw_bbox = draw_bbox - vol_bbox.minpt
     if any(x != 0 for x in pad):
@@ -101,26 +113,45 @@ def _draw_bounding_cube(cv_path: str, bbox, mip: int, pad: Tuple[int, int, int])
 
 
 def cloudvolume_to_dir(
-    cv_path: str, dst_path: str, bbox, parameters: dict, author: str, extension="tif"
+    cv_path: str,
+    dst_path: str,
+    bbox,
+    parameters: dict,
+    author: str,
+    extension="tif",
+    notify: callable = print,
 ):
-    """Save bbox from src_path to directory of tifs at dst_path."""
+    """
+    Save bbox from src_path to directory of tifs at dst_path.
+    Cutouts too large for the memory budget are made at a higher mip.
+    """
     from datetime import datetime
     from json import dumps
     from cloudfiles import CloudFiles
+    from .admission import budget
+    from .admission import cutout_mip
     from .data_io import write_to_cloud_bucket
 
     mip = parameters["mip"]
     pad = parameters["pad"]
 
-    img_arr, draw_bbox = _draw_bounding_cube(cv_path, bbox, mip, pad)
+    dst_mip, nbytes = cutout_mip(cv_path, bbox, mip, pad)
+    if dst_mip != mip:
+        notify(f"Cutout does not fit in memory at mip {mip}, using mip {dst_mip}.")
     dst_path = os.path.join(os.environ["GT_BUCKET_PATH"], dst_path)
-    write_to_cloud_bucket(os.path.join(dst_path, "raw"), img_arr, extension=extension)
+    with budget.reserve(nbytes, notify):
+        img_arr, draw_bbox = _draw_bounding_cube(
+            cv_path, bbox, dst_mip, pad, src_mip=mip
+        )
+        write_to_cloud_bucket(
+            os.path.join(dst_path, "raw"), img_arr, extension=extension
+        )
     params = {
         "raw": {
             "pad": pad,
             "bbox": bbox,
             "src_mip": mip,
-            "dst_mip": mip,
+            "dst_mip": dst_mip,
             "voxel_size": parameters["voxel_size"],
             "user": author,
             "timestamp": str(datetime.utcnow()),
@@ -139,6 +170,6 @@ def cloudvolume_to_dir(
     msg += f"Image layer: `{cv_path}`\n"
     msg += f"Bounding box: [{', '.join(str(x) for x in bbox)}]\n"
     msg += f"Size: [{', '.join(str(int(x)) for x in draw_bbox.size3())}]\n"
-    msg += f"Mip level: {mip}\n"
+    msg += f"Mip level: {dst_mip}\n"
     msg += f"Padding: [{', '.join(str(x) for x in pad)}]\n"
     return msg
\ No newline at end of file
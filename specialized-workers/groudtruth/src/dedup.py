@@ -0,0 +1,198 @@
+"""
+Duplicate commands (Slack retries, users re-running a command that looks stuck)
+join the job already running for the same inputs, or get its cached result.
+Results are kept in `GT_BUCKET_PATH/.cache`, keyed on the command and
+a fingerprint of its inputs.
+"""
+from os import environ
+from time import time
+from typing import Any
+from typing import Tuple
+from typing import Optional
+from threading import Lock
+from threading import Event
+from threading import Thread
+
+
+# a running job refreshes its lease every third of this,
+# an older lease is from a crashed worker
+LEASE_TTL = float(environ.get("GT_DEDUP_LEASE_TTL", 600))
+
+_lock = Lock()
+_in_flight = {}
+
+
+def fingerprint(*parts) -> str:
+    from json import dumps
+    from hashlib import sha256
+
+    return sha256(dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def preview_key(path: str, transpose: bool, voxel_size) -> str:
+    """Options and size, etag and modification time of every file in `path`."""
+    from cloudfiles import CloudFiles
+
+    cf = CloudFiles(path)
+    names = sorted(cf.list())
+    return fingerprint(
+        "preview", path.rstrip("/"), transpose, list(voxel_size), cf.head(names)
+    )
+
+
+def cutout_key(state: dict, parameters: dict) -> str:
+    return fingerprint("cutouts", state, parameters)
+
+
+class _Cache:
+    """
+    JSON markers in `GT_BUCKET_PATH/.cache`.
+    On GCS a write can be conditional on the generation that was read, so two
+    workers cannot both take the same lease. Elsewhere (local paths in
+    development) the condition is not checked and leases are best effort.
+    """
+
+    def __init__(self):
+        self.path = f"{environ['GT_BUCKET_PATH']}/.cache"
+        self.gcs = self.path.startswith("gs://")
+
+    def _blob(self, name: str):
+        from google.cloud.storage import Client
+
+        bucket, _, prefix = self.path[len("gs://") :].partition("/")
+        return Client().bucket(bucket).blob(f"{prefix}/{name}".lstrip("/"))
+
+    def get(self, name: str) -> Tuple[Optional[dict], int]:
+        """Marker and its generation, `0` when there is none."""
+        from json import loads
+        from cloudfiles import CloudFiles
+        from google.api_core.exceptions import NotFound
+
+        if not self.gcs:
+            return CloudFiles(self.path).get_json(name), 0
+        blob = self._blob(name)
+        try:
+            blob.reload()
+            content = blob.download_as_bytes(if_generation_match=blob.generation)
+        except NotFound:
+            return None, 0
+        return loads(content), blob.generation
+
+    def put(self, name: str, value: dict, generation: int = None) -> Optional[int]:
+        """
+        New generation, `None` if `generation` is given and the marker changed
+        since it was read. `0` is the generation of a missing marker.
+        """
+        from json import dumps
+        from cloudfiles import CloudFiles
+        from google.api_core.exceptions import PreconditionFailed
+
+        if not self.gcs:
+            CloudFiles(self.path).put_json(name, value)
+            return 0
+        blob = self._blob(name)
+        try:
+            blob.upload_from_string(
+                dumps(value),
+                content_type="application/json",
+                if_generation_match=generation,
+            )
+        except PreconditionFailed:
+            return None
+        return blob.generation
+
+    def delete(self, name: str) -> None:
+        from cloudfiles import CloudFiles
+
+        CloudFiles(self.path).delete(name)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _heartbeat(cache: _Cache, name: str, lease: dict, generation: int, stop: Event):
+    """Refreshes `lease` until `stop`, or until another worker took it over."""
+    while not stop.wait(LEASE_TTL / 3):
+        lease["heartbeat"] = time()
+        generation = cache.put(name, lease, generation)
+        if generation is None:
+            print(f"lease {name} was taken over")
+            return
+
+
+def run_once(
+    key: str,
+    fn: callable,
+    notify: callable = print,
+    force: bool = False,
+    owner: str = None,
+) -> Tuple[Any, bool]:
+    """
+    Result of `fn()`, computed once for `key`, and whether this call computed it.
+    A call with a `key` already running in this process waits for it,
+    one running in another worker is not started again and the result is `None`.
+    A worker running `fn` holds a lease on `key`, refreshed while `fn` runs.
+    A lease of the same `owner` (the event of a redelivered message) or
+    one that was not refreshed for `GT_DEDUP_LEASE_TTL` is taken over.
+    `force` ignores the cached result and leases of other workers.
+    """
+    with _lock:
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = _Flight()
+
+    if not leader:
+        notify("Same job is already running, waiting for it to finish.")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, False
+
+    name = f"{key}.json"
+    try:
+        cache = _Cache()
+        cached, generation = cache.get(name)
+        if cached and not force:
+            if cached["status"] == "done":
+                notify("Same job finished before, reusing its result.")
+                flight.result = cached["result"]
+                return flight.result, False
+            mine = owner is not None and cached.get("owner") == owner
+            if not mine and time() - cached.get("heartbeat", 0) < LEASE_TTL:
+                notify("Same job is already running on another worker.")
+                return None, False
+
+        lease = {"status": "pending", "owner": owner, "heartbeat": time()}
+        generation = cache.put(name, lease, generation)
+        if generation is None:
+            notify("Same job was just started on another worker.")
+            return None, False
+
+        stop = Event()
+        beat = Thread(
+            target=_heartbeat, args=(cache, name, lease, generation, stop), daemon=True
+        )
+        beat.start()
+        try:
+            flight.result = fn()
+        except Exception:
+            stop.set()
+            beat.join()
+            cache.delete(name)
+            raise
+        stop.set()
+        beat.join()
+        cache.put(name, {"status": "done", "result": flight.result})
+        return flight.result, True
+    except Exception as err:
+        flight.error = err
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        flight.done.set()
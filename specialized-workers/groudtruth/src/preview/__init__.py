@@ -1,8 +1,9 @@
 # pylint: disable=no-member, unsupported-assignment-operation
 from typing import Tuple
 from os import environ
+from functools import partial
 from datetime import datetime
-from secrets import token_hex
+from contextlib import nullcontext
 
 
 from numpy import ndarray
@@ -10,8 +11,11 @@ import igneous.task_creation as tc
 from cloudvolume import CloudVolume
 from taskqueue import LocalTaskQueue
 from CloudBotWorkersCommon.slack import Response as SlackResponse
+from CloudBotWorkersCommon.metrics import Trace
 
 from .meta import Meta as PreviewMeta
+from .journal import Journal
+from .journal import job_id
 from ..utils import checkpoint_notify
 
 
@@ -21,28 +25,68 @@ def upload(
     voxel_size: Tuple,
     slack_response: SlackResponse,
     transpose: bool = False,
-) -> None:
+) -> str:
+    """Returns the neuroglancer link."""
     from cloudvolume.lib import Vec
     from ..data_io import load_images
+    from ..admission import budget
+    from ..admission import preview_bytes
     from .utils import create_nglink
 
+    trace = Trace("gt volume preview")
     checkpoint_notify("Parsing metadata.", slack_response)
-    meta = PreviewMeta(p, author=author)
+    with trace.span("meta"):
+        meta = PreviewMeta(p, author=author)
     if not meta.voxel_size:
         # use user input only when voxel size is not available in meta
         meta.voxel_size = voxel_size
 
-    checkpoint_notify(f"Loading data from {p}.", slack_response)
-    data = load_images(p)
-    checkpoint_notify("Loading data complete.", slack_response)
+    event = slack_response.event
+    journal = Journal(
+        author, job_id(p, transpose, event.get("channel"), event.get("event_ts"))
+    )
+    if journal.resumed:
+        checkpoint_notify("Resuming from the last run.", slack_response)
 
-    ng_layers = {}
-    for k, d in data.items():
-        checkpoint_notify(f"Creating layer: {k}", slack_response)
-        ng_layers[k] = upload_seg(meta, d, slack_response, transpose=transpose)
+    # data is only needed until every layer is written
+    load = not journal.layers or not all(
+        journal.done(f"{k}: write") for k in journal.layers
+    )
+    notify = partial(checkpoint_notify, slack_response=slack_response)
+    with budget.reserve(preview_bytes(meta), notify) if load else nullcontext():
+        if load:
+            checkpoint_notify(f"Loading data from {p}.", slack_response)
+            with trace.span("load_images") as span:
+                data = load_images(p)
+                span.add_bytes(sum(d.nbytes for d in data.values()))
+            checkpoint_notify("Loading data complete.", slack_response)
+            journal.layers = list(data)
+            journal.save()
+        else:
+            data = dict.fromkeys(journal.layers)
+
+        ng_layers = {}
+        for k, d in data.items():
+            checkpoint_notify(f"Creating layer: {k}", slack_response)
+            ng_layers[k] = upload_seg(
+                meta,
+                d,
+                slack_response,
+                transpose=transpose,
+                trace=trace,
+                layer=k,
+                journal=journal,
+            )
+        del data
 
     checkpoint_notify("Creating neuroglancer link.", slack_response)
-    checkpoint_notify(create_nglink(ng_layers, meta), slack_response, broadcast=True)
+    with trace.span("nglink"):
+        nglink = create_nglink(ng_layers, meta)
+    # the dedup cache keeps the result, nothing resumes from here anymore
+    journal.delete()
+    checkpoint_notify(nglink, slack_response, broadcast=True)
+    checkpoint_notify(f"```{trace.summary()}```", slack_response)
+    return nglink
 
 
 def upload_seg(
@@ -50,61 +94,99 @@ def upload_seg(
     data: ndarray,
     slack_response: SlackResponse,
     transpose: bool = False,
+    trace: Trace = None,
+    layer: str = "seg",
+    journal: Journal = None,
 ):
+    """
+    Stages finished in `journal` are skipped,
+    `data` is not used when the layer was written in an earlier run.
+    """
+    from secrets import token_hex
     from numpy import transpose as np_transpose
 
-    em = CloudVolume(meta.em_layer, mip=meta.dst_mip)
-    output_layer = f"{environ['GT_BUCKET_PATH']}/{meta.author}/preview/{token_hex(8)}"
-    info = CloudVolume.create_new_info(
-        num_channels=1,
-        layer_type="segmentation",
-        data_type="uint32",
-        encoding="raw",
-        resolution=em.resolution,
-        voxel_offset=meta.dst_bbox.minpt,
-        volume_size=meta.dst_bbox.size3(),
-        mesh=f"mesh_mip_{meta.dst_mip}_err_0",
-        chunk_size=(64, 64, 8),
-    )
+    trace = trace or Trace("gt volume preview")
+    journal = journal or Journal(meta.author, token_hex(8))
+    output_layer = f"{environ['GT_BUCKET_PATH']}/{meta.author}/preview/"
+    output_layer += job_id(journal.job, layer)
+    if journal.done(f"{layer}: write"):
+        return _create_tasks(meta, output_layer, slack_response, trace, layer, journal)
+
+    with trace.span(f"{layer}: info", stage="info"):
+        em = CloudVolume(meta.em_layer, mip=meta.dst_mip)
+        info = CloudVolume.create_new_info(
+            num_channels=1,
+            layer_type="segmentation",
+            data_type="uint32",
+            encoding="raw",
+            resolution=em.resolution,
+            voxel_offset=meta.dst_bbox.minpt,
+            volume_size=meta.dst_bbox.size3(),
+            mesh=f"mesh_mip_{meta.dst_mip}_err_0",
+            chunk_size=(64, 64, 8),
+        )
 
-    dst_cv = CloudVolume(output_layer, info=info, mip=0, cdn_cache=False)
-    dst_cv.provenance.description = "Image directory ingest"
-    dst_cv.provenance.processing.append(
-        {
-            "method": {
-                "task": "ingest",
-                "image_path": meta.em_layer,
-            },
-            "date": str(datetime.today()),
-            "script": "cloud_bot",
-        }
-    )
-    dst_cv.provenance.owners = [meta.author]
-    dst_cv.commit_info()
-    dst_cv.commit_provenance()
+        dst_cv = CloudVolume(output_layer, info=info, mip=0, cdn_cache=False)
+        dst_cv.provenance.description = "Image directory ingest"
+        dst_cv.provenance.processing.append(
+            {
+                "method": {
+                    "task": "ingest",
+                    "image_path": meta.em_layer,
+                },
+                "date": str(datetime.today()),
+                "script": "cloud_bot",
+            }
+        )
+        dst_cv.provenance.owners = [meta.author]
+        dst_cv.commit_info()
+        dst_cv.commit_provenance()
 
     checkpoint_notify("Processing data.", slack_response)
-    crop_bbox = meta.dst_bbox - meta.src_bbox.minpt
-    data = data[crop_bbox.to_slices()]
-    dst_cv[meta.dst_bbox.to_slices()] = (
-        np_transpose(data, (1, 0, 2)) if transpose else data
-    )
+    with trace.span(f"{layer}: write", stage="write") as span:
+        crop_bbox = meta.dst_bbox - meta.src_bbox.minpt
+        data = data[crop_bbox.to_slices()]
+        dst_cv[meta.dst_bbox.to_slices()] = (
+            np_transpose(data, (1, 0, 2)) if transpose else data
+        )
+        span.add_bytes(data.nbytes)
+    journal.finish(f"{layer}: write")
+    return _create_tasks(meta, output_layer, slack_response, trace, layer, journal)
+
 
+def _create_tasks(
+    meta: PreviewMeta,
+    output_layer: str,
+    slack_response: SlackResponse,
+    trace: Trace,
+    layer: str,
+    journal: Journal,
+):
+    """Downsampling and meshing, resumed from the tasks finished in `journal`."""
     with LocalTaskQueue(parallel=16) as tq:
-        tasks = tc.create_downsampling_tasks(
-            output_layer, mip=0, fill_missing=True, preserve_chunk_size=True
-        )
-        tq.insert_all(tasks)
+        stage = f"{layer}: downsample"
+        if not journal.done(stage):
+            with trace.span(stage, stage="downsample"):
+                tasks = tc.create_downsampling_tasks(
+                    output_layer, mip=0, fill_missing=True, preserve_chunk_size=True
+                )
+                journal.run_tasks(tq, stage, tasks)
 
         checkpoint_notify("Creating meshing tasks.", slack_response)
-        tasks = tc.create_meshing_tasks(
-            output_layer,
-            mip=meta.dst_mip,
-            simplification=False,
-            shape=(320, 320, 40),
-            max_simplification_error=0,
-        )
-        tq.insert_all(tasks)
-        tasks = tc.create_mesh_manifest_tasks(output_layer, magnitude=1)
-        tq.insert_all(tasks)
-    return output_layer
\ No newline at end of file
+        stage = f"{layer}: mesh"
+        if not journal.done(stage):
+            with trace.span(stage, stage="mesh"):
+                tasks = tc.create_meshing_tasks(
+                    output_layer,
+                    mip=meta.dst_mip,
+                    simplification=False,
+                    shape=(320, 320, 40),
+                    max_simplification_error=0,
+                )
+                journal.run_tasks(tq, stage, tasks)
+        stage = f"{layer}: mesh_manifest"
+        if not journal.done(stage):
+            with trace.span(stage, stage="mesh_manifest"):
+                tasks = tc.create_mesh_manifest_tasks(output_layer, magnitude=1)
+                journal.run_tasks(tq, stage, tasks)
+    return output_layer
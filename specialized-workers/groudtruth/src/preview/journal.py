@@ -0,0 +1,75 @@
+from os import environ
+from typing import Iterable
+
+
+# igneous tasks run between journal saves
+TASK_BATCH = 128
+
+
+def job_id(*parts) -> str:
+    """Same id for a redelivered message, so the retry finds its journal."""
+    from hashlib import sha256
+
+    return sha256(":".join(str(p) for p in parts).encode()).hexdigest()[:16]
+
+
+class Journal:
+    """
+    Finished stages and igneous tasks of a preview job.
+    Saved next to the previews after every change,
+    a retried job skips what is already done. Deleted once the job finished.
+    """
+
+    def __init__(self, author: str, job: str):
+        from json import loads
+        from cloudfiles import CloudFiles
+
+        self.job = job
+        self._cf = CloudFiles(f"{environ['GT_BUCKET_PATH']}/{author}/preview/.journal")
+        self._name = f"{job}.json"
+        state = self._cf.get(self._name)
+        state = loads(state) if state else {}
+        self.layers = state.get("layers", [])
+        self.stages = state.get("stages", [])
+        self.tasks = state.get("tasks", {})
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.layers)
+
+    def done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def finish(self, stage: str) -> None:
+        self.stages.append(stage)
+        self.save()
+
+    def save(self) -> None:
+        from json import dumps
+
+        self._cf.put(
+            self._name,
+            dumps({"layers": self.layers, "stages": self.stages, "tasks": self.tasks}),
+            content_type="application/json",
+        )
+
+    def delete(self) -> None:
+        self._cf.delete(self._name)
+
+    def run_tasks(self, tq, stage: str, tasks: Iterable) -> None:
+        """Runs `tasks` in batches, skipping the ones finished in earlier runs."""
+        from itertools import islice
+
+        tasks = iter(tasks)
+        done = self.tasks.get(stage, 0)
+        for _ in islice(tasks, done):
+            pass
+        while True:
+            batch = list(islice(tasks, TASK_BATCH))
+            if not batch:
+                break
+            tq.insert_all(batch)
+            done += len(batch)
+            self.tasks[stage] = done
+            self.save()
+        self.finish(stage)
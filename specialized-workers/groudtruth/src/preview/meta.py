@@ -79,6 +79,14 @@ class Meta:
         self.dst_mip = parameters["dst_mip"]
         self.dst_bbox = Bbox(vol_start, vol_stop)
         self.src_bbox = Bbox(self.dst_bbox.minpt - pad, self.dst_bbox.maxpt + pad)
+        if "raw" in raw_meta and self.src_mip != self.dst_mip:
+            # cutout was downgraded to a higher mip, see `admission.cutout_mip`
+            from cloudvolume import CloudVolume
+
+            cv = CloudVolume(self.em_layer, mip=self.dst_mip)
+            self.dst_bbox = cv.bbox_to_mip(self.dst_bbox, self.src_mip, self.dst_mip)
+            self.src_bbox = cv.bbox_to_mip(self.src_bbox, self.src_mip, self.dst_mip)
+        # in the coordinates of `voxel_size`, the bbox as given before any downgrade
         self.center = (vol_start + vol_stop) // 2
 
     def __str__(self) -> str:
@@ -16,19 +16,12 @@ def checkpoint_notify(
 
 
 def get_username(user_id: str) -> str:
-    from requests import get
-    from CloudBotWorkersCommon import config
+    from CloudBotWorkersCommon.slack import get_username as get_slack_username
 
     try:
-        headers = {"Authorization": f"Bearer {config.SLACK_API_BOT_ACCESS_TOKEN}"}
-        response = get(
-            config.SLACK_API_USER_INFO,
-            headers=headers,
-            params={"user": user_id},
-        )
-        response = response.json()
-        return response["user"]["real_name"].lower().replace(" ", "_")
-    except:
+        return get_slack_username(user_id)
+    except Exception as err:
+        print(f"could not get username for {user_id}: {repr(err)}")
         return "cloud_bot_gtbot"
 
 